@@ -0,0 +1,593 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import guidance
+from completion_cache import CACHE, RECORD, REPLAY, CachingLLM, CompletionCache
+from local_llm import LocalLLM
+from main import Agent, AgentCore, TEMPLATE_MAX_TOKENS, rubric_prompt
+import metrics
+import prescreen
+import routing
+from rubric_store import RubricStore
+from scheduler import Scheduler, TOKENS_PER_MINUTE
+from template_kinds import template_kind
+import test_data
+from token_caps import token_caps
+
+ESSAYS = (('poor', test_data.baseball_poor), ('fair', test_data.baseball_fair), ('good', test_data.baseball_good),
+          ('excellent', test_data.baseball_excellent))
+TOPICS = ('baseball', 'soccer', 'swimming', 'chess')
+QUALITIES = ('Low', 'Medium', 'High')
+
+# the template whose calls are counted for each stage, any calls beyond one per stage run are retries
+STAGE_TEMPLATES = {'rubric': 'rubric', 'question': 'question', 'validity': 'validity', 'score': 'grading',
+                   'test': 'test'}
+
+
+def count_tokens(text):
+    # approximate, but the same for every backend, so reports can be compared
+    return len(text) // 4
+
+
+# how many of each template's earlier prompts to look for a shared prefix in
+PREFIX_HISTORY = 50
+
+
+# the templates that are called to grade an essay, on either the multi-call or the fused path
+GRADING_KINDS = ('validity', 'grading', 'grading_qa', 'fused_grading')
+
+# the routings that --compare-routes compares when no file of them is given, the first being the reference
+# that the others' gradings are compared with
+DEFAULT_ROUTINGS = {
+    'gpt-4': {},
+    'fast-validity-and-test': {'validity': ['gpt-3.5-turbo', 'gpt-4'], 'test': ['gpt-3.5-turbo', 'gpt-4']},
+}
+
+# the modules that are slow to import, which a cold start shouldn't need before its first render
+HEAVY_MODULES = ('guidance', 'openai', 'streamlit', 'test_data')
+STARTUP_STAGES = ('import', 'core', 'first_render', 'first_call')
+
+# one cold start, in a fresh interpreter: import the grader, make the core and a session, and render the grade's
+# stored rubric, as the page does first, then make the first LLM call, on the local backend, which has to import
+# guidance and compile the template
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+agent = main.Agent(None, core=main.AgentCore(None))
+created = time.perf_counter()
+agent.generate_rubric(sys.argv[1])
+assert agent.get_display_rubric()
+rendered = time.perf_counter()
+loaded = [name for name in json.loads(sys.argv[2]) if name in sys.modules]
+from local_llm import LocalLLM
+main.AgentCore(None, LocalLLM(0, 0)).create_question(sys.argv[1], agent.rubric, 'baseball')
+called = time.perf_counter()
+print(json.dumps({'import': imported - start, 'core': created - imported, 'first_render': rendered - created,
+                  'first_call': called - rendered, 'loaded': loaded}))
+"""
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+# counts the calls and tokens of each template, for completions from the backend and from a recording alike
+class CountingLLM(CachingLLM):
+    def __init__(self, llm, cache=None, mode=CACHE, model_name=None):
+        super().__init__(llm, cache, mode, model_name)
+        self.calls = {}
+        self.prompt_tokens = {}
+        self.completion_tokens = {}
+        self.prefix_tokens = {}
+        self.prompts = {}
+
+    def completed(self, prompt, text, finish_reason):
+        self.count(template_kind(prompt), prompt, text)
+
+    def count(self, kind, prompt, text):
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        self.prompt_tokens[kind] = self.prompt_tokens.get(kind, 0) + count_tokens(prompt)
+        self.completion_tokens[kind] = self.completion_tokens.get(kind, 0) + count_tokens(text)
+        # the start of the prompt that an earlier call of the same template already sent, which a
+        # provider's prompt cache could reuse
+        prompts = self.prompts.setdefault(kind, [])
+        prefix = max((len(os.path.commonprefix((prompt, earlier))) for earlier in prompts), default=0)
+        self.prefix_tokens[kind] = self.prefix_tokens.get(kind, 0) + count_tokens(prompt[:prefix])
+        prompts.append(prompt)
+        del prompts[:-PREFIX_HISTORY]
+
+
+def recording(path):
+    # the completion cache that --record saves to and --replay answers from, which keeps every completion
+    return CompletionCache(path, ttl=None) if path else None
+
+
+def timed(timings, stage, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    timings.setdefault(stage, []).append(time.perf_counter() - start)
+    return result
+
+
+def streamed(first_content, stage):
+    # returns an on_partial callback that records how long the stage took to produce its first output
+    start = time.perf_counter()
+    seen = []
+
+    def on_partial(text):
+        if not seen:
+            seen.append(True)
+            first_content.setdefault(stage, []).append(time.perf_counter() - start)
+
+    return on_partial
+
+
+def early_abort_stats():
+    # LLM calls that the Agent abandoned part way, and the completion tokens that saved, per template
+    stats = {}
+    for labels, count in metrics.early_aborts.values.items():
+        template = dict(labels)['template']
+        stats.setdefault(template, {'aborts': 0, 'saved_tokens': 0})['aborts'] += count
+    for labels, tokens in metrics.early_abort_saved_tokens.values.items():
+        stats.setdefault(dict(labels)['template'], {'aborts': 0, 'saved_tokens': 0})['saved_tokens'] += tokens
+    return stats
+
+
+def stage_tries():
+    # the tries that each stage's runs have taken so far, and how many runs there were, from the stage traces
+    with metrics.registry.lock:
+        return {dict(labels)['stage']: (total, count)
+                for labels, (_, total, count) in metrics.stage_tries.values.items()}
+
+
+def run_benchmark(llm, grade, iterations, stream=False):
+    # the benchmark measures the pipeline itself, so it isn't held back by the API rate limits
+    agent = Agent(None, llm=llm, scheduler=Scheduler(None, None))
+    timings = {}
+    first_content = {}
+    failures = {}
+    graded = 0
+    invalid = 0
+    start_tries = stage_tries()
+
+    for iteration in range(iterations):
+        # call the LLM directly rather than going through the shared rubric store and question cache
+        agent.grade = grade
+        agent.rubric = timed(timings, 'rubric', agent.create_rubric, grade)
+        if not agent.rubric:
+            failures['rubric'] = failures.get('rubric', 0) + 1
+            continue
+        agent.max_score = len(agent.rubric) * 3
+
+        agent.topic = TOPICS[iteration % len(TOPICS)]
+        agent.question = timed(timings, 'question', agent.create_question, grade, agent.rubric, agent.topic)
+        if not agent.question:
+            failures['question'] = failures.get('question', 0) + 1
+            continue
+
+        previous_essay = ''
+        for name, essay in ESSAYS:
+            validity = timed(timings, 'validity', agent.check_valid, essay)
+            if not validity:
+                failures['validity'] = failures.get('validity', 0) + 1
+                continue
+            # like grade_async, invalid essays aren't scored
+            if not validity['valid']:
+                invalid += 1
+                continue
+            if not timed(timings, 'score', agent.score, essay, previous_essay,
+                         streamed(first_content, 'score') if stream else None):
+                failures['score'] = failures.get('score', 0) + 1
+                continue
+            graded += 1
+            previous_essay = essay
+
+        for quality in QUALITIES:
+            if not timed(timings, 'test', agent.get_test_data, quality,
+                         streamed(first_content, 'test') if stream else None):
+                failures['test'] = failures.get('test', 0) + 1
+
+    end_tries = stage_tries()
+    stages = {}
+    for stage, kind in STAGE_TEMPLATES.items():
+        values = timings.get(stage, [])
+        # tries beyond the first of each run, which doesn't count the runs that the prescreen answered
+        tries, runs = (end - start for end, start in zip(end_tries.get(stage, (0, 0)), start_tries.get(stage, (0, 0))))
+        stages[stage] = {
+            'runs': len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+            'mean': sum(values) / len(values) if values else None,
+            'llm_calls': llm.calls.get(kind, 0),
+            'retries': tries - runs,
+            'failures': failures.get(stage, 0),
+        }
+        if stage in first_content:
+            stages[stage]['first_content_p50'] = percentile(first_content[stage], 50)
+            stages[stage]['first_content_p95'] = percentile(first_content[stage], 95)
+    return {
+        'config': {'grade': grade, 'iterations': iterations, 'model': llm.model_name, 'stream': stream},
+        'stages': stages,
+        'templates': template_tokens(llm),
+        'graded_essays': graded,
+        'invalid_essays': invalid,
+        'llm_calls_per_graded_essay': sum(llm.calls.get(kind, 0) for kind in GRADING_KINDS) / graded if graded else None,
+        'tokens_per_graded_essay': sum(llm.prompt_tokens.get(kind, 0) + llm.completion_tokens.get(kind, 0)
+                                       for kind in GRADING_KINDS) / graded if graded else None,
+        'early_aborts': early_abort_stats(),
+        'prescreen': prescreen.stats(),
+        'token_caps': token_caps.report(TEMPLATE_MAX_TOKENS, TOKENS_PER_MINUTE),
+    }
+
+
+def template_tokens(llm):
+    # the prompt tokens of each template, and how many of them repeat the start of an earlier prompt
+    return {kind: {'calls': llm.calls[kind],
+                   'prompt_tokens': llm.prompt_tokens[kind],
+                   'prompt_tokens_per_call': llm.prompt_tokens[kind] / llm.calls[kind],
+                   'prefix_tokens': llm.prefix_tokens[kind],
+                   'uncached_prompt_tokens': llm.prompt_tokens[kind] - llm.prefix_tokens[kind],
+                   'completion_tokens': llm.completion_tokens[kind]} for kind in sorted(llm.calls)}
+
+
+def _grading_usage(llm):
+    return (sum(llm.calls.get(kind, 0) for kind in GRADING_KINDS),
+            sum(llm.prompt_tokens.get(kind, 0) for kind in GRADING_KINDS),
+            sum(llm.completion_tokens.get(kind, 0) for kind in GRADING_KINDS))
+
+
+def run_fused_comparison(llm, grade, iterations):
+    # grades the same essays with the multi-call path (validity check alongside a speculative grading)
+    # and with the single fused call, and reports the latency and LLM cost per essay of each
+    agent = Agent(None, llm=llm, scheduler=Scheduler(None, None))
+    agent.grade = grade
+    agent.rubric = agent.create_rubric(grade)
+    agent.max_score = len(agent.rubric) * 3
+    agent.get_question(TOPICS[0])
+
+    modes = {}
+    for mode, fused in (('multi_call', False), ('fused', True)):
+        agent.core.fused = fused
+        timings = []
+        failures = 0
+        calls, prompt_tokens, completion_tokens = _grading_usage(llm)
+        for iteration in range(iterations):
+            previous_essay = ''
+            for name, essay in ESSAYS:
+                start = time.perf_counter()
+                validity, score = asyncio.run(agent.grade_async(essay, previous_essay))
+                timings.append(time.perf_counter() - start)
+                if not validity or (validity['valid'] and not score):
+                    failures += 1
+                    continue
+                previous_essay = essay
+        end_calls, end_prompt_tokens, end_completion_tokens = _grading_usage(llm)
+        modes[mode] = {
+            'essays': len(timings),
+            'failures': failures,
+            'p50': percentile(timings, 50),
+            'p95': percentile(timings, 95),
+            'mean': sum(timings) / len(timings),
+            'llm_calls_per_essay': (end_calls - calls) / len(timings),
+            'prompt_tokens_per_essay': (end_prompt_tokens - prompt_tokens) / len(timings),
+            'completion_tokens_per_essay': (end_completion_tokens - completion_tokens) / len(timings),
+        }
+    return {'config': {'grade': grade, 'iterations': iterations, 'model': llm.model_name}, 'grading': modes}
+
+
+def _revised_prompt_tokens(llm):
+    # the prompt tokens of the templates that are given the previous essay
+    return sum(llm.prompt_tokens.get(kind, 0) for kind in ('grading', 'fused_grading'))
+
+
+def run_revision_comparison(llm, grade, iterations):
+    # grades each test_data essay as a revision of the one before it, once with the whole previous essay in the
+    # prompt and once with only the changes and the previous grading, and reports the cost of each revision
+    agent = Agent(None, llm=llm, scheduler=Scheduler(None, None))
+    agent.grade = grade
+    agent.rubric = agent.create_rubric(grade)
+    agent.max_score = len(agent.rubric) * 3
+    agent.get_question(TOPICS[0])
+    # a light edit of the excellent essay, which is the usual kind of revision, besides the rewrites between the
+    # essays of each quality
+    edited = test_data.baseball_excellent.replace('Baseball, often referred to as', 'Baseball, which is often called')
+    essays = [essay for name, essay in ESSAYS] + [edited]
+
+    modes = {}
+    for mode, compact in (('full_previous_essay', False), ('compact', True)):
+        agent.core.compact_revisions = compact
+        timings = []
+        failures = 0
+        usage = [0, 0, 0]
+        grading_prompt_tokens = 0
+        for iteration in range(iterations):
+            agent.gradings.clear()
+            # the first essay is graded without a previous one, and isn't counted
+            asyncio.run(agent.grade_async(essays[0], ''))
+            previous_essay = essays[0]
+            start_usage = _grading_usage(llm)
+            start_grading = _revised_prompt_tokens(llm)
+            for essay in essays[1:]:
+                start = time.perf_counter()
+                validity, score = asyncio.run(agent.grade_async(essay, previous_essay))
+                timings.append(time.perf_counter() - start)
+                if not validity or (validity['valid'] and not score):
+                    failures += 1
+                previous_essay = essay
+            usage = [total + end - start for total, start, end in zip(usage, start_usage, _grading_usage(llm))]
+            grading_prompt_tokens += _revised_prompt_tokens(llm) - start_grading
+        calls, prompt_tokens, completion_tokens = usage
+        modes[mode] = {
+            'revisions': len(timings),
+            'failures': failures,
+            'p50': percentile(timings, 50),
+            'p95': percentile(timings, 95),
+            'mean': sum(timings) / len(timings),
+            'llm_calls_per_revision': calls / len(timings),
+            'prompt_tokens_per_revision': prompt_tokens / len(timings),
+            'grading_prompt_tokens_per_revision': grading_prompt_tokens / len(timings),
+            'completion_tokens_per_revision': completion_tokens / len(timings),
+        }
+    full, compact = modes['full_previous_essay'], modes['compact']
+    savings = {field: (full[field] - compact[field]) / full[field] if full[field] else None
+               for field in ('prompt_tokens_per_revision', 'grading_prompt_tokens_per_revision',
+                             'completion_tokens_per_revision', 'p50', 'mean')}
+    return {'config': {'grade': grade, 'iterations': iterations, 'model': llm.model_name}, 'revisions': modes,
+            'savings': savings}
+
+
+def run_route_comparison(make_llm, grade, iterations, routings):
+    # grades the test_data essays and generates test essays with each routing of the templates to models,
+    # and reports the latency and LLM usage of each, and how often its gradings agree with the first routing's
+    agents = {}
+    for name, config in routings.items():
+        routes = routing.parse_routes(config)
+        llms = {model: make_llm(model) for model in routing.Router(routes).models}
+        agents[name] = (Agent(None, core=AgentCore(None, scheduler=Scheduler(None, None), routes=routes, llms=llms)),
+                        llms)
+
+    # every routing grades against the same rubric and question, so that only the routed templates differ
+    reference = next(iter(agents))
+    agent = agents[reference][0]
+    rubric = agent.create_rubric(grade)
+    question = agent.create_question(grade, rubric, TOPICS[0])
+
+    results = {}
+    for name, (agent, llms) in agents.items():
+        agent.grade, agent.rubric, agent.max_score = grade, rubric, len(rubric) * 3
+        agent.topic, agent.question = TOPICS[0], question
+        timings = {'grading': [], 'test': []}
+        gradings = []
+        for iteration in range(iterations):
+            for essay_name, essay in ESSAYS:
+                start = time.perf_counter()
+                validity, score = asyncio.run(agent.grade_async(essay, ''))
+                timings['grading'].append(time.perf_counter() - start)
+                gradings.append((essay_name, validity and validity['valid'], score and score['total']))
+            for quality in QUALITIES:
+                timed(timings, 'test', agent.get_test_data, quality)
+        results[name] = {
+            'routes': {template: route['models'] for template, route in agent.core.router.routes.items()},
+            'stages': {stage: {'p50': percentile(values, 50), 'p95': percentile(values, 95),
+                               'mean': sum(values) / len(values)} for stage, values in timings.items()},
+            'models': {model: {'calls': sum(llm.calls.values()), 'prompt_tokens': sum(llm.prompt_tokens.values()),
+                               'completion_tokens': sum(llm.completion_tokens.values()),
+                               'templates': sorted(llm.calls)} for model, llm in llms.items()},
+            'gradings': gradings,
+        }
+
+    reference_gradings = results[reference]['gradings']
+    for name, result in results.items():
+        pairs = list(zip(reference_gradings, result.pop('gradings')))
+        totals = [(ours[2], theirs[2]) for theirs, ours in pairs if ours[2] is not None and theirs[2] is not None]
+        result['agreement'] = {
+            'reference': reference,
+            'validity': sum(ours[1] == theirs[1] for theirs, ours in pairs) / len(pairs),
+            'total_exact': sum(ours == theirs for ours, theirs in totals) / len(totals) if totals else None,
+            'total_mean_abs_diff': sum(abs(ours - theirs) for ours, theirs in totals) / len(totals) if totals else None,
+        }
+    return {'config': {'grade': grade, 'iterations': iterations}, 'routings': results}
+
+
+def import_profile(env, min_seconds=0.005):
+    # the seconds that importing each of the modules that the grader imports directly takes, from -X importtime,
+    # which lists each import after the ones it makes, indented by how deep it is
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], env=env,
+                            capture_output=True, text=True, check=True)
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0 and name.strip() == 'main':
+            break
+        if depth == 0:
+            imports = {}
+        elif depth == 1 and int(cumulative) / 1e6 >= min_seconds:
+            imports[name.strip()] = int(cumulative) / 1e6
+    return dict(sorted(imports.items(), key=lambda item: -item[1]))
+
+
+def run_startup_benchmark(grade, iterations):
+    # cold starts with a stored rubric, so the first render needs no LLM call, as on a deployment where the
+    # rubrics have been precomputed
+    directory = tempfile.mkdtemp(prefix='startup-benchmark-')
+    token_caps.path = os.path.join(directory, 'token_caps.json')
+    core = AgentCore(None, LocalLLM(0, 0))
+    RubricStore(directory).put(core.standard, grade, rubric_prompt, AgentCore(None).model_name('rubric'),
+                               core.create_rubric(grade))
+    env = {**os.environ, 'RUBRIC_STORE_DIR': directory, 'TOKEN_CAPS_FILE': token_caps.path}
+
+    timings = {stage: [] for stage in STARTUP_STAGES}
+    loaded = set()
+    for _ in range(iterations):
+        result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, grade, json.dumps(HEAVY_MODULES)], env=env,
+                                capture_output=True, text=True, check=True)
+        # the grader logs to stdout too, the timings are the last line
+        run = json.loads(result.stdout.splitlines()[-1])
+        for stage in STARTUP_STAGES:
+            timings[stage].append(run[stage])
+        loaded.update(run['loaded'])
+    return {
+        'config': {'grade': grade, 'iterations': iterations},
+        'startup': {stage: {'p50': percentile(values, 50), 'max': max(values)} for stage, values in timings.items()},
+        'time_to_first_render': percentile([sum(run) for run in zip(*(timings[stage] for stage in
+                                                                     ('import', 'core', 'first_render')))], 50),
+        'loaded_before_first_render': sorted(loaded),
+        'imports': import_profile(env),
+    }
+
+
+def compare_startup(report, baseline):
+    changes = []
+    for stage, values in report['startup'].items():
+        old = baseline.get('startup', {}).get(stage, {})
+        if old.get('p50'):
+            changes.append(f'{stage} {(values["p50"] - old["p50"]) / old["p50"]:+.0%}')
+    if baseline.get('time_to_first_render'):
+        old = baseline['time_to_first_render']
+        changes.append(f'time_to_first_render {(report["time_to_first_render"] - old) / old:+.0%}')
+    print(f'startup: {", ".join(changes)}', file=sys.stderr)
+
+
+def compare(report, baseline):
+    # prints the relative change of each stage's latency and LLM usage against an earlier report
+    for stage, values in report['stages'].items():
+        old = baseline['stages'].get(stage, {})
+        changes = []
+        for field in ('p50', 'p95', 'p99', 'llm_calls', 'retries'):
+            if old.get(field) and values[field] is not None:
+                changes.append(f'{field} {(values[field] - old[field]) / old[field]:+.0%}')
+        print(f'{stage}: {", ".join(changes)}', file=sys.stderr)
+    for kind, values in report['templates'].items():
+        old = baseline.get('templates', {}).get(kind, {})
+        changes = []
+        for field in ('prompt_tokens_per_call', 'uncached_prompt_tokens', 'completion_tokens'):
+            if old.get(field) and values.get(field) is not None:
+                changes.append(f'{field} {(values[field] - old[field]) / old[field]:+.0%}')
+        print(f'{kind} template: {", ".join(changes)}', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the grading pipeline stages and report latency '
+                                                 'percentiles, LLM calls, retries and tokens as JSON.')
+    parser.add_argument('--backend', choices=('local', 'openai'), default='local',
+                        help='LLM backend to run against (defaults to the local stand-in)')
+    parser.add_argument('--api-key', default=None, help='OpenAI API key (defaults to $OPENAI_API_KEY)')
+    parser.add_argument('--grade', default='Fourth', help='grade level to benchmark')
+    parser.add_argument('--iterations', type=int, default=5, help='number of times to run the whole pipeline')
+    parser.add_argument('--latency', type=float, default=0.5, help='local backend mean latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.2, help='local backend latency standard deviation')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='local backend fraction of bad outputs')
+    parser.add_argument('--tokens-per-second', type=float, default=0,
+                        help='local backend generation speed, 0 for instant')
+    parser.add_argument('--seed', type=int, default=0, help='local backend random seed')
+    parser.add_argument('--record', help='save the completions to this completion cache file, for later replay')
+    parser.add_argument('--replay', help='replay the completions recorded in this file from --backend instead of '
+                                         'calling it')
+    parser.add_argument('--baseline', help='earlier report to compare the results against')
+    parser.add_argument('--stream', action='store_true',
+                        help='stream the grading and test essays, and report their time to first content')
+    parser.add_argument('--compare-fused', action='store_true',
+                        help='only compare the multi-call grading path against the single fused grading call')
+    parser.add_argument('--compare-revisions', action='store_true',
+                        help='only compare grading revisions with the whole previous essay against only its changes')
+    parser.add_argument('--compare-routes', action='store_true',
+                        help='only compare routings of the templates to models, on latency and grading agreement')
+    parser.add_argument('--routes', help='JSON file of the routings to compare, each a name and its MODEL_ROUTES')
+    parser.add_argument('--model-latency', action='append', default=[], metavar='MODEL=SECONDS',
+                        help='local backend mean latency of a model, may be repeated (defaults to --latency)')
+    parser.add_argument('--token-caps-report', action='store_true',
+                        help="only report each template's token cap and the rate limit headroom it gives back, from "
+                             'the completion sizes recorded so far')
+    parser.add_argument('--startup', action='store_true',
+                        help='only time cold starts in fresh processes: importing, making the core, rendering the '
+                             'first page and making the first LLM call')
+    parser.add_argument('--output', help='file to write the report to (defaults to stdout)')
+    args = parser.parse_args()
+
+    if args.startup:
+        with contextlib.redirect_stdout(sys.stderr):
+            report = run_startup_benchmark(args.grade, args.iterations)
+        if args.baseline:
+            with open(args.baseline, 'r') as file:
+                compare_startup(report, json.load(file))
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(report, file, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+        return
+
+    if args.token_caps_report:
+        print(json.dumps(token_caps.report(TEMPLATE_MAX_TOKENS, TOKENS_PER_MINUTE), indent=2))
+        return
+
+    if args.compare_routes:
+        routings = DEFAULT_ROUTINGS
+        if args.routes:
+            with open(args.routes, 'r') as file:
+                routings = json.load(file)
+        model_latency = {model: float(seconds) for model, seconds in
+                         (value.split('=', 1) for value in args.model_latency)}
+        if args.backend == 'openai':
+            def make_llm(model):
+                return CountingLLM(guidance.llms.OpenAI(model, api_key=args.api_key, max_retries=20))
+        else:
+            def make_llm(model):
+                return CountingLLM(LocalLLM(model_latency.get(model, args.latency), args.jitter, args.failure_rate,
+                                            args.tokens_per_second, seed=args.seed))
+        with contextlib.redirect_stdout(sys.stderr):
+            report = run_route_comparison(make_llm, args.grade, args.iterations, routings)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(report, file, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+        return
+
+    if args.replay:
+        # the backend is never called, so the stand-in does, with the completions keyed by the recorded model
+        llm = CountingLLM(LocalLLM(), recording(args.replay), REPLAY, 'gpt-4' if args.backend == 'openai' else None)
+    elif args.backend == 'openai':
+        llm = CountingLLM(guidance.llms.OpenAI('gpt-4', api_key=args.api_key, max_retries=20),
+                          recording(args.record), RECORD if args.record else CACHE)
+    else:
+        llm = CountingLLM(LocalLLM(args.latency, args.jitter, args.failure_rate, args.tokens_per_second,
+                                   seed=args.seed), recording(args.record), RECORD if args.record else CACHE)
+
+    # the Agent logs its progress with print(), so keep that out of the report on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.compare_fused:
+            report = run_fused_comparison(llm, args.grade, args.iterations)
+        elif args.compare_revisions:
+            report = run_revision_comparison(llm, args.grade, args.iterations)
+        else:
+            report = run_benchmark(llm, args.grade, args.iterations, args.stream)
+
+    if args.baseline and not args.compare_fused and not args.compare_revisions:
+        with open(args.baseline, 'r') as file:
+            compare(report, json.load(file))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import guidance
+from guidance.llms._llm import LLMSession, SyncSession
+from template_kinds import template_kind
+import metrics
+from token_caps import finish_reasons
+
+# cache modes: use cached completions and save new ones, always call the backend and save its completions,
+# or only answer from the saved completions without ever calling the backend
+CACHE = 'cache'
+RECORD = 'record'
+REPLAY = 'replay'
+MODES = (CACHE, RECORD, REPLAY)
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+# the generation parameters that change what a completion can be; max_tokens isn't one of them, as the caps
+# that token_caps learns change it without changing the completion, and completions cut off by it aren't saved
+KEY_PARAMS = ('stop', 'temperature', 'top_p', 'n', 'logprobs', 'function_call')
+
+cache_lookups = metrics.registry.counter('grader_completion_cache_total',
+                                         'Completion cache lookups, by template and result')
+
+
+class ReplayMissError(Exception):
+    pass
+
+
+# persistent, content-addressed store of LLM completions in SQLite, which evicts the least recently used
+# completions once the stored text goes over max_bytes, and expires them after ttl seconds (None to keep them)
+class CompletionCache:
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                         'size INTEGER NOT NULL, created REAL NOT NULL, used REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS completions_used ON completions (used)')
+
+    @staticmethod
+    def key(prompt, model, **params):
+        key_str = json.dumps([prompt, model, {name: params.get(name) for name in KEY_PARAMS}], sort_keys=True)
+        return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT value, created FROM completions WHERE key = ?', (key,)).fetchone()
+            if row and self.ttl is not None and row[1] < now - self.ttl:
+                self._db.execute('DELETE FROM completions WHERE key = ?', (key,))
+                self.expired += 1
+                row = None
+            if not row:
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE completions SET used = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key, value):
+        value_str = json.dumps(value)
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)',
+                             (key, value_str, len(value_str), now, now))
+            self._evict()
+
+    def discard(self, key):
+        with self._lock:
+            self._db.execute('DELETE FROM completions WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM completions')
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions').fetchone()
+        lookups = self.hits + self.misses
+        return {'entries': entries, 'bytes': size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None, 'expired': self.expired,
+                'evictions': self.evictions}
+
+    def _evict(self):
+        if self.ttl is not None:
+            self.expired += self._db.execute('DELETE FROM completions WHERE created < ?',
+                                             (time.time() - self.ttl,)).rowcount
+        size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+        if size <= self.max_bytes:
+            return
+        for key, entry_size in self._db.execute('SELECT key, size FROM completions ORDER BY used').fetchall():
+            if size <= self.max_bytes:
+                break
+            self._db.execute('DELETE FROM completions WHERE key = ?', (key,))
+            size -= entry_size
+            self.evictions += 1
+
+
+# wraps another LLM backend to see each of its completions, and to answer repeated temperature=0 calls from a
+# CompletionCache if it is given one, since they would only produce the same completion again (completions
+# are recorded and replayed the same way, with the RECORD and REPLAY modes)
+class CachingLLM(guidance.llms.LLM):
+    def __init__(self, llm, cache=None, mode=CACHE, model_name=None):
+        super().__init__()
+        if mode not in MODES:
+            raise Exception(f'unknown completion cache mode: {mode}')
+        self.llm = llm
+        self.chat_mode = llm.chat_mode
+        # the model that completions are cached under, which can be another backend's to replay its completions
+        self.model_name = model_name or llm.model_name
+        self.completion_cache = cache
+        self.mode = mode
+
+    def session(self, asynchronous=False):
+        if asynchronous:
+            return CachingSession(self)
+        else:
+            return SyncSession(CachingSession(self))
+
+    def role_start(self, role_name, **kwargs):
+        return self.llm.role_start(role_name, **kwargs)
+
+    def role_end(self, role_name=None):
+        return self.llm.role_end(role_name)
+
+    def encode(self, string, **kwargs):
+        return self.llm.encode(string, **kwargs)
+
+    def decode(self, tokens, **kwargs):
+        return self.llm.decode(tokens, **kwargs)
+
+    def completed(self, prompt, text, finish_reason):
+        # called with every completion, whether it came from the cache or the backend, and with as much of a
+        # stream as was read when it is abandoned part way
+        pass
+
+
+class CachingSession(LLMSession):
+    async def __call__(self, prompt, temperature=0, stream=None, caching=None, **kwargs):
+        kwargs = {**kwargs, 'temperature': temperature}
+        cache = self.llm.completion_cache
+        key = None
+        if cache and not temperature:
+            key = cache.key(prompt, self.llm.model_name, **kwargs)
+            # a caching of False asks for a fresh completion, because the cached one was no good
+            if self.llm.mode == REPLAY or (self.llm.mode == CACHE and caching is not False):
+                out = cache.get(key)
+                with metrics.registry.lock:
+                    cache_lookups.inc(template=template_kind(prompt) or 'unknown', result='hit' if out else 'miss')
+                if out:
+                    self._completed(prompt, out['choices'][0]['text'], out['choices'][0].get('finish_reason'))
+                    return self._stream(out) if stream else out
+                if self.llm.mode == REPLAY:
+                    raise ReplayMissError(f'no recorded completion for {template_kind(prompt)} prompt {key}')
+
+        with self.llm.llm.session(asynchronous=True) as session:
+            out = await session(prompt, stream=stream, **kwargs)
+        if stream:
+            return self._follow_stream(prompt, key, out)
+        finish_reason = out['choices'][0].get('finish_reason')
+        self._completed(prompt, out['choices'][0]['text'], finish_reason)
+        # truncated completions aren't worth answering again
+        if key and finish_reason != 'length':
+            cache.put(key, out)
+        return out
+
+    async def _follow_stream(self, prompt, key, chunks):
+        text = ''
+        finish_reason = None
+        try:
+            async for chunk in chunks:
+                text += chunk['choices'][0]['text']
+                finish_reason = chunk['choices'][0].get('finish_reason') or finish_reason
+                yield chunk
+        finally:
+            self._completed(prompt, text, finish_reason)
+        if key and finish_reason != 'length':
+            self.llm.completion_cache.put(key, {'choices': [{'text': text, 'finish_reason': finish_reason}]})
+
+    def _completed(self, prompt, text, finish_reason):
+        reasons = finish_reasons.get()
+        if reasons is not None and finish_reason:
+            reasons.append(finish_reason)
+        self.llm.completed(prompt, text, finish_reason)
+
+    @staticmethod
+    async def _stream(out):
+        yield out
+
+
+def from_env():
+    # the cache is opt-in: set COMPLETION_CACHE to the SQLite file to keep the completions in
+    path = os.environ.get('COMPLETION_CACHE')
+    if not path:
+        return None, None
+    # a TTL of 0 keeps the completions until they are evicted
+    ttl = float(os.environ.get('COMPLETION_CACHE_TTL', DEFAULT_TTL)) or None
+    cache = CompletionCache(path, int(os.environ.get('COMPLETION_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)), ttl)
+    return cache, os.environ.get('COMPLETION_CACHE_MODE', CACHE)
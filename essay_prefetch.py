@@ -0,0 +1,89 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+import metrics
+
+# generate the test essays of a question ahead of time, while the scheduler can spare the tokens for them
+ENABLED = os.environ.get('TEST_PREFETCH', '1') not in ('', '0')
+# the share of the rate limits that has to be left over after the prefetches for them to be started
+SPARE_CAPACITY = float(os.environ.get('TEST_PREFETCH_SPARE_CAPACITY', 0.5))
+# the most test essays that are generated in the background at once, across all sessions
+DEFAULT_CONCURRENCY = int(os.environ.get('TEST_PREFETCH_CONCURRENCY', 2))
+# how often a session that is waiting for a prefetch passes on its output so far, in seconds
+PARTIAL_INTERVAL = 0.1
+
+test_prefetches = metrics.registry.counter('grader_test_prefetch_total',
+                                           'Test essays generated ahead of time and how they were used, by result')
+
+
+def count(result):
+    with metrics.registry.lock:
+        test_prefetches.inc(result=result)
+
+
+# a coroutine submitted to the prefetcher: its future, whether it has got past the concurrency limit and
+# started running, and the output that it has streamed so far
+class Prefetch:
+    def __init__(self):
+        self.future = None
+        self.started = False
+        self.partial = None
+
+    def on_partial(self, text):
+        self.partial = text
+
+    def cancel(self):
+        return self.future.cancel()
+
+    def wait(self, timeout=None, on_partial=None):
+        # the coroutine's result, passing its output so far on to on_partial in the waiting thread, or
+        # TimeoutError if it isn't done after timeout seconds
+        end = None if timeout is None else time.monotonic() + timeout
+        shown = None
+        while True:
+            interval = PARTIAL_INTERVAL if end is None else min(PARTIAL_INTERVAL, max(0.0, end - time.monotonic()))
+            try:
+                return self.future.result(interval)
+            except concurrent.futures.TimeoutError:
+                if end is not None and time.monotonic() >= end:
+                    raise
+            if on_partial and self.partial and self.partial != shown:
+                shown = self.partial
+                on_partial(shown)
+
+
+# runs coroutines on an event loop of its own, in a background thread, so that they carry on between the
+# reruns of a session's script and can be cancelled part way when they are no longer wanted
+class Prefetcher:
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        self.concurrency = concurrency
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def submit(self, make_coroutine):
+        # make_coroutine is passed the callback to stream the coroutine's output to, and the Prefetch's
+        # cancel() stops the coroutine even if it is running
+        prefetch = Prefetch()
+        prefetch.future = asyncio.run_coroutine_threadsafe(self._limited(make_coroutine, prefetch), self._start())
+        return prefetch
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='test-prefetch', daemon=True).start()
+            return self._loop
+
+    async def _limited(self, make_coroutine, prefetch):
+        # only ever run on the prefetch loop, so the semaphore belongs to it
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            prefetch.started = True
+            return await make_coroutine(prefetch.on_partial)
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import re
+import sys
+from completion_cache import CachingLLM
+from local_llm import LocalLLM
+from main import Agent, GRADES
+import prescreen
+from scheduler import scheduler, BATCH
+
+
+def load_essays(path):
+    essays = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if os.path.splitext(name)[1] in ('.txt', '.md'):
+                with open(os.path.join(path, name), 'r') as file:
+                    essays.append({'id': os.path.splitext(name)[0], 'essay': file.read(), 'previous_essay': ''})
+    else:
+        with open(path, 'r') as file:
+            for line_num, line in enumerate(file, 1):
+                if line.strip():
+                    entry = json.loads(line)
+                    essays.append({'id': entry.get('id', line_num), 'essay': entry['essay'],
+                                   'previous_essay': entry.get('previous_essay', '')})
+    return essays
+
+
+async def grade_essays(agent, essays, concurrency, output):
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = 0
+
+    async def grade_essay(entry):
+        async with semaphore:
+            try:
+                validity, score = await agent.grade_async(entry['essay'], entry['previous_essay'])
+                error = None
+                if not validity:
+                    error = 'validity check failed'
+                elif validity['valid'] and not score:
+                    error = 'grading failed'
+            except Exception as exc:
+                validity, score, error = None, None, str(exc)
+            return {'id': entry['id'], 'validity': validity, 'score': score, 'max_score': agent.get_max_score(),
+                    'error': error}
+
+    # write out each result as soon as its essay has finished grading
+    for result in asyncio.as_completed([grade_essay(entry) for entry in essays]):
+        result = await result
+        if result['error']:
+            failed += 1
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+    return failed
+
+
+def grade(args, output):
+    agent = Agent(args.api_key, priority=BATCH, llm=LocalLLM() if args.local_llm else None)
+    agent.generate_rubric(args.grade)
+    if not agent.rubric:
+        print('error generating rubric', file=sys.stderr)
+        return 1
+
+    if args.question_file:
+        with open(args.question_file, 'r') as file:
+            agent.question = file.read()
+        # the question's Introduction names its topic
+        match = re.search(r'on the subject of ([^.]+)\.', agent.question)
+        agent.topic = args.topic or (match.group(1) if match else agent.question)
+    elif not agent.get_question(args.topic):
+        print('error generating question', file=sys.stderr)
+        return 1
+
+    essays = load_essays(args.essays)
+    failed = asyncio.run(grade_essays(agent, essays, args.concurrency, output))
+    print(f'graded {len(essays) - failed} of {len(essays)} essays', file=sys.stderr)
+    print(f'scheduler: {json.dumps(scheduler.metrics())}', file=sys.stderr)
+    if isinstance(agent.llm, CachingLLM):
+        print(f'completion cache: {json.dumps(agent.llm.completion_cache.stats())}', file=sys.stderr)
+    print(f'prescreen: {json.dumps(prescreen.stats())}', file=sys.stderr)
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Grade a whole set of essays, writing the results as JSONL.')
+    parser.add_argument('essays', help='directory of .txt/.md essays, or a JSONL file of {"id", "essay", '
+                                       '"previous_essay"} objects')
+    parser.add_argument('--grade', required=True, choices=GRADES, help='grade level of the students')
+    parser.add_argument('--topic', help='topic of the essays, used to generate the question if none is given')
+    parser.add_argument('--question-file', help='file containing the question that the essays respond to')
+    parser.add_argument('--concurrency', type=int, default=4, help='maximum number of essays graded at once')
+    parser.add_argument('--output', help='file to write the results to (defaults to stdout)')
+    parser.add_argument('--api-key', default=None, help='OpenAI API key (defaults to $OPENAI_API_KEY)')
+    parser.add_argument('--local-llm', action='store_true', help='use the local stand-in LLM instead of OpenAI')
+    args = parser.parse_args()
+    if not args.topic and not args.question_file:
+        parser.error('either --topic or --question-file is required')
+
+    # the Agent logs its progress with print(), so keep that out of the results on stdout
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            return grade(args, output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    exit(main())
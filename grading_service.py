@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+from aiohttp import web
+from main import Agent, AgentCore, GRADES, QUALITIES
+from rubric_store import check_rubric
+import metrics
+from scheduler import PRIORITY_NAMES
+from token_caps import token_caps
+from upstream import OPEN
+
+# requests that are graded at once, and that can wait for a worker before new ones are turned away
+DEFAULT_WORKERS = int(os.environ.get('SERVICE_WORKERS', 8))
+DEFAULT_QUEUE_SIZE = int(os.environ.get('SERVICE_QUEUE_SIZE', 100))
+# how long clients are told to wait before retrying a request that was turned away
+RETRY_AFTER_SECONDS = 1
+
+service_requests = metrics.registry.counter('grader_service_requests_total',
+                                            'Grading service requests, by endpoint and HTTP status')
+service_request_seconds = metrics.registry.histogram('grader_service_request_seconds',
+                                                     'Wall time of grading service requests, including queueing')
+service_queue_seconds = metrics.registry.histogram('grader_service_queue_seconds',
+                                                   'Time grading service requests waited for a worker')
+
+
+class BadRequestError(Exception):
+    pass
+
+
+class OverloadedError(Exception):
+    pass
+
+
+# a fixed number of workers that run the queued jobs, so that a burst of requests queues up instead of all
+# calling the LLM at once, and requests beyond what the queue holds are turned away straight away
+class WorkerPool:
+    def __init__(self, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE):
+        self.workers = workers
+        self.queue = asyncio.Queue(queue_size)
+        self.busy = 0
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def run(self, endpoint, make_coroutine):
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self.queue.put_nowait((endpoint, make_coroutine, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            raise OverloadedError(f'{self.queue.qsize()} requests are already waiting')
+        return await future
+
+    async def _work(self):
+        while True:
+            endpoint, make_coroutine, future, queued = await self.queue.get()
+            try:
+                # the client may have gone away while the job was queued
+                if future.cancelled():
+                    continue
+                with metrics.registry.lock:
+                    service_queue_seconds.observe(time.perf_counter() - queued, endpoint=endpoint)
+                self.busy += 1
+                try:
+                    result = await make_coroutine()
+                except Exception as exc:
+                    if not future.done():
+                        future.set_exception(exc)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                finally:
+                    self.busy -= 1
+            finally:
+                self.queue.task_done()
+
+
+# the grading stages over HTTP, each request carrying all the session state that the stage needs, so that
+# any instance of the service can serve any request
+class GradingService:
+    def __init__(self, core, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE):
+        self.core = core
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pool = None
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([web.post('/rubric', self.rubric),
+                        web.post('/question', self.question),
+                        web.post('/validity', self.validity),
+                        web.post('/grade', self.grade),
+                        web.post('/test-essay', self.test_essay),
+                        web.get('/health', self.health),
+                        web.get('/metrics', self.metrics)])
+        app.on_startup.append(self._start)
+        app.on_cleanup.append(self._stop)
+        return app
+
+    async def _start(self, app):
+        self.pool = WorkerPool(self.workers, self.queue_size)
+        self.pool.start()
+
+    async def _stop(self, app):
+        await self.pool.stop()
+
+    async def rubric(self, request):
+        return await self._handle('rubric', request, self._rubric)
+
+    async def question(self, request):
+        return await self._handle('question', request, self._question)
+
+    async def validity(self, request):
+        return await self._handle('validity', request, self._validity)
+
+    async def grade(self, request):
+        return await self._handle('grade', request, self._grade)
+
+    async def test_essay(self, request):
+        return await self._handle('test_essay', request, self._test_essay)
+
+    async def health(self, request):
+        # degraded while any model's circuit is open, which the load balancer can still send requests to
+        circuits = {model: breaker.state for model, breaker in self.core.router.breakers.items()}
+        return web.json_response({
+            'status': 'degraded' if OPEN in circuits.values() else 'ok',
+            'workers': self.workers,
+            'busy_workers': self.pool.busy,
+            'queue_depth': self.pool.queue.qsize(),
+            'queue_size': self.queue_size,
+            'circuits': circuits,
+        })
+
+    async def metrics(self, request):
+        return web.Response(text=metrics.registry.render(), content_type='text/plain')
+
+    async def _handle(self, endpoint, request, stage):
+        start = time.perf_counter()
+        try:
+            try:
+                body = await request.json()
+            except json.JSONDecodeError:
+                raise BadRequestError('request body isn\'t JSON')
+            if not isinstance(body, dict):
+                raise BadRequestError('request body isn\'t a JSON object')
+            session = await self._session(body)
+            result = await self.pool.run(endpoint, lambda: stage(session, body))
+            status, response = (200, result) if result else (502, {'error': f'{endpoint} failed, please retry'})
+        except BadRequestError as exc:
+            status, response = 400, {'error': str(exc)}
+        except OverloadedError as exc:
+            status, response = 503, {'error': f'overloaded: {exc}'}
+        except Exception as exc:
+            print(f'error in {endpoint}: {exc}')
+            status, response = 500, {'error': str(exc)}
+        with metrics.registry.lock:
+            service_requests.inc(endpoint=endpoint, status=status)
+            service_request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+        headers = {'Retry-After': str(RETRY_AFTER_SECONDS)} if status == 503 else None
+        return web.json_response(response, status=status, headers=headers)
+
+    async def _session(self, body):
+        grade = body.get('grade')
+        if grade not in GRADES:
+            raise BadRequestError(f'grade has to be one of {", ".join(GRADES)}')
+        priorities = {name: priority for priority, name in PRIORITY_NAMES.items()}
+        if body.get('priority', 'interactive') not in priorities:
+            raise BadRequestError(f'priority has to be one of {", ".join(priorities)}')
+        session = Agent(None, priority=priorities[body.get('priority', 'interactive')], core=self.core)
+        session.grade = grade
+        session.topic = body.get('topic')
+        session.question = body.get('question')
+        return session
+
+    async def _session_rubric(self, session, body):
+        # the rubric can be passed back in, or looked up, which is quick once the grade's rubric is stored
+        if body.get('rubric'):
+            try:
+                check_rubric(body['rubric'])
+            except Exception as exc:
+                raise BadRequestError(f'rubric isn\'t valid: {exc}')
+            session.rubric = body['rubric']
+        else:
+            session.rubric = await self._in_thread(self.core.get_rubric, session.grade, session.priority)
+        session.max_score = len(session.rubric) * 3 if session.rubric else None
+        return session.rubric
+
+    @staticmethod
+    def _require(body, *fields):
+        for field in fields:
+            if not isinstance(body.get(field), str) or not body[field]:
+                raise BadRequestError(f'{field} is required')
+
+    @staticmethod
+    async def _in_thread(func, *args):
+        # the stages that only have synchronous versions are run off the event loop
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def _rubric(self, session, body):
+        rubric = await self._session_rubric(session, body)
+        return rubric and {'rubric': rubric, 'max_score': session.max_score}
+
+    async def _question(self, session, body):
+        self._require(body, 'topic')
+        rubric = await self._session_rubric(session, body)
+        if not rubric:
+            return None
+        question = await self._in_thread(self.core.get_question, session.grade, rubric, session.topic,
+                                         session.priority)
+        # None is a question that couldn't be generated, and an empty one a topic that was turned down
+        if question is None:
+            return None
+        if session.topic not in question:
+            raise BadRequestError('can\'t produce a prompt for that topic, please choose a different one')
+        return {'question': question}
+
+    async def _validity(self, session, body):
+        self._require(body, 'topic', 'question', 'essay')
+        validity = await self.core.check_valid_async(session, body['essay'])
+        return validity and {'validity': validity}
+
+    async def _grade(self, session, body):
+        self._require(body, 'topic', 'question', 'essay')
+        if not await self._session_rubric(session, body):
+            return None
+        validity, score = await self.core.grade_async(session, body['essay'], body.get('previous_essay', ''))
+        if not validity or (validity['valid'] and not score):
+            return None
+        return {'validity': validity, 'score': score, 'max_score': session.max_score}
+
+    async def _test_essay(self, session, body):
+        self._require(body, 'question')
+        if body.get('quality') not in QUALITIES:
+            raise BadRequestError(f'quality has to be one of {", ".join(QUALITIES)}')
+        essay = await self.core.get_test_data_async(session, body['quality'])
+        return essay and {'essay': essay}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the grading stages over HTTP, as JSON.')
+    parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='maximum number of requests run at once')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='maximum number of requests waiting for a worker before new ones get a 503')
+    parser.add_argument('--api-key', default=None, help='OpenAI API key (defaults to $OPENAI_API_KEY)')
+    parser.add_argument('--local-llm', action='store_true', help='use the local stand-in LLM instead of OpenAI')
+    args = parser.parse_args()
+
+    llm = None
+    if args.local_llm:
+        from local_llm import LocalLLM
+        llm = LocalLLM()
+        # the stand-in's completion sizes say nothing about the real models', so keep them out of the caps file
+        token_caps.path = os.path.join(tempfile.mkdtemp(prefix='grading-service-token-caps-'), 'token_caps.json')
+    core = AgentCore(args.api_key, llm)
+    service = GradingService(core, args.workers, args.queue_size)
+    # the Agent logs its progress with print(), so keep that with the server's own logging
+    with contextlib.redirect_stdout(sys.stderr):
+        web.run_app(service.app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import json
+import metrics
+
+WHITESPACE = ' \t\r\n'
+LITERALS = ('true', 'false', 'null')
+NUMBER_CHARS = '0123456789+-.eE'
+
+
+class JSONStreamError(Exception):
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+# parses JSON output as it is generated, calling check(path, value) on every value as soon as it is complete
+# (where path is the keys and indexes that lead to it), and raises JSONStreamError as soon as the output can
+# no longer be valid JSON of the expected type, or when check raises, so that the generation can be abandoned
+class JSONStreamParser:
+    def __init__(self, expect=dict, check=None):
+        self.expect = expect
+        self.check = check
+        self.text = ''
+        self.value = None
+        self.done = False
+        self._stack = []
+        self._state = 'value'
+        self._token = ''
+        self._escape = False
+        self._is_key = False
+        self._pos = 0
+
+    def feed(self, text):
+        # takes the whole output so far, which only ever grows while it is generated
+        if not text.startswith(self.text):
+            raise JSONStreamError('output changed while it was being parsed', metrics.JSON_PARSE)
+        new_text = text[len(self.text):]
+        self.text = text
+        for char in new_text:
+            self._pos += 1
+            self._char(char)
+
+    def _error(self, message):
+        raise JSONStreamError(f'{message} at character {self._pos}: {self.text[max(0, self._pos - 40):self._pos]!r}',
+                              metrics.JSON_PARSE)
+
+    def _char(self, char):
+        state = self._state
+        if state == 'string':
+            self._string_char(char)
+        elif state == 'number':
+            if char in NUMBER_CHARS:
+                self._token += char
+            else:
+                self._finish_token()
+                self._char(char)
+        elif state == 'literal':
+            self._token += char
+            if not any(literal.startswith(self._token) for literal in LITERALS):
+                self._error(f'invalid literal {self._token!r}')
+            if self._token in LITERALS:
+                self._finish_token()
+        elif char in WHITESPACE:
+            pass
+        elif state in ('value', 'value_or_end'):
+            if state == 'value_or_end' and char == ']':
+                self._close(list)
+            else:
+                self._start_value(char)
+        elif state in ('key', 'key_or_end'):
+            if state == 'key_or_end' and char == '}':
+                self._close(dict)
+            elif char == '"':
+                self._state, self._token, self._is_key = 'string', '', True
+            else:
+                self._error('expected a key')
+        elif state == 'colon':
+            if char != ':':
+                self._error('expected ":"')
+            self._state = 'value'
+        elif state == 'after_value':
+            container = self._stack[-1][0]
+            if char == ',':
+                self._state = 'key' if isinstance(container, dict) else 'value'
+            elif char in '}]':
+                self._close(dict if char == '}' else list)
+            else:
+                self._error('expected "," or the end of the container')
+        else:
+            self._error('unexpected output after the JSON')
+
+    def _start_value(self, char):
+        if not self._stack and self.value is None and char != ('{' if self.expect is dict else '['):
+            self._error(f'expected a JSON {"object" if self.expect is dict else "array"}')
+        if char == '{':
+            self._stack.append(({}, None))
+            self._state = 'key_or_end'
+        elif char == '[':
+            self._stack.append(([], None))
+            self._state = 'value_or_end'
+        elif char == '"':
+            self._state, self._token, self._is_key = 'string', '', False
+        elif char in '-0123456789':
+            self._state, self._token = 'number', char
+        elif char in 'tfn':
+            self._state, self._token = 'literal', char
+        else:
+            self._error(f'unexpected {char!r}')
+
+    def _string_char(self, char):
+        if self._escape:
+            self._escape = False
+        elif char == '\\':
+            self._escape = True
+        elif char == '"':
+            self._finish_token()
+            return
+        self._token += char
+
+    def _finish_token(self):
+        try:
+            value = json.loads(f'"{self._token}"' if self._state == 'string' else self._token, strict=False)
+        except json.JSONDecodeError:
+            self._error(f'invalid value {self._token!r}')
+        if self._state == 'string' and self._is_key:
+            container = self._stack[-1][0]
+            self._stack[-1] = (container, value)
+            self._state = 'colon'
+        else:
+            self._finish_value(value)
+
+    def _close(self, container_type):
+        container, key = self._stack[-1]
+        if not isinstance(container, container_type):
+            self._error('mismatched end of container')
+        self._stack.pop()
+        self._finish_value(container)
+
+    def _path(self):
+        return tuple(key if isinstance(container, dict) else len(container) for container, key in self._stack)
+
+    def _finish_value(self, value):
+        if self.check:
+            try:
+                self.check(self._path(), value)
+            except Exception as exc:
+                raise JSONStreamError(str(exc), metrics.SANITY_CHECK) from exc
+        if self._stack:
+            container, key = self._stack[-1]
+            if isinstance(container, dict):
+                container[key] = value
+            else:
+                container.append(value)
+            self._state = 'after_value'
+        else:
+            self.value = value
+            self.done = True
+            self._state = 'end'
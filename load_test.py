@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from benchmark import percentile
+from local_llm import LocalLLM
+from main import Agent, AgentCore, GRADES
+import metrics
+from rubric_store import rubric_store
+from scheduler import Scheduler, scheduler as default_scheduler
+import test_data
+from token_caps import token_caps
+
+# the essay that each simulated student submits first, and the revision that they resubmit
+REVISIONS = ((test_data.baseball_poor, test_data.baseball_fair), (test_data.baseball_fair, test_data.baseball_good),
+             (test_data.baseball_good, test_data.baseball_excellent))
+# the steps of a session that the student waits on, in order
+STEPS = ('rubric', 'question', 'grade', 'revision')
+
+
+def think(rng, mean):
+    # the student reading the page before the next step
+    if mean:
+        time.sleep(rng.expovariate(1 / mean))
+
+
+def deep_size(obj, seen=None):
+    # the memory that an object and everything it refers to takes up, counting shared objects once
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, Future):
+        return sys.getsizeof(obj) + (deep_size(obj.result(), seen) if obj.done() and not obj.cancelled()
+                                     and obj.exception() is None else 0)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(vars(obj), seen)
+    return size
+
+
+def session_size(agent):
+    # what one session keeps in memory between reruns, not counting the core that all sessions share
+    return deep_size({name: value for name, value in vars(agent).items() if name != 'core'})
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# one simulated student, who goes through the same steps as the Streamlit page: choose a grade, enter a topic,
+# submit an essay and then a revision of it
+def run_session(core, rng, args, timings, lock):
+    agent = Agent(None, core=core)
+    step_times = {}
+
+    def step(name, func, *func_args):
+        start = time.perf_counter()
+        result = func(*func_args)
+        step_times[name] = time.perf_counter() - start
+        return result
+
+    step('rubric', agent.generate_rubric, rng.choice(args.grades))
+    ok = bool(agent.rubric)
+    if ok:
+        think(rng, args.think_time)
+        ok = bool(step('question', agent.get_question, rng.choice(args.topics)))
+    if ok:
+        if args.prefetch_test_essays:
+            agent.prefetch_test_data()
+        essay, revision = rng.choice(REVISIONS)
+        think(rng, args.think_time)
+        validity, score = step('grade', lambda: asyncio.run(agent.grade_async(essay, '')))
+        ok = bool(validity and (score or not validity['valid']))
+    if ok:
+        think(rng, args.think_time)
+        validity, score = step('revision', lambda: asyncio.run(agent.grade_async(revision, essay)))
+        ok = bool(validity and (score or not validity['valid']))
+
+    with lock:
+        for name, seconds in step_times.items():
+            timings.setdefault(name, []).append(seconds)
+    return agent, ok
+
+
+def llm_usage():
+    # LLM calls and seconds spent waiting in the scheduler so far, by template
+    with metrics.registry.lock:
+        calls = {}
+        for labels, count in metrics.llm_calls.values.items():
+            template = dict(labels)['template']
+            calls[template] = calls.get(template, 0) + count
+        queued = {dict(labels)['template']: (total, count)
+                  for labels, (_, total, count) in metrics.llm_queue_seconds.values.items()}
+    return calls, queued
+
+
+def run_level(core, scheduler, concurrency, args, seed):
+    # keeps this many sessions going at once for the duration, each thread starting a new session as soon as
+    # its last one is done, like concurrent Streamlit script runs
+    timings = {}
+    lock = threading.Lock()
+    sessions = []
+    failed = []
+    end = time.monotonic() + args.duration
+    calls, queued = llm_usage()
+    scheduler_start = scheduler.metrics()
+    start = time.perf_counter()
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        while time.monotonic() < end:
+            agent, ok = run_session(core, rng, args, timings, lock)
+            with lock:
+                # the sessions stay in memory, as Streamlit keeps them until their browser tab is closed
+                sessions.append(agent)
+                if not ok:
+                    failed.append(agent)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker, index) for index in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    end_calls, end_queued = llm_usage()
+    scheduler_end = scheduler.metrics()
+    queue_waits = {}
+    for template, (total, count) in end_queued.items():
+        old_total, old_count = queued.get(template, (0, 0))
+        if count > old_count:
+            queue_waits[template] = (total - old_total) / (count - old_count)
+    sizes = [session_size(agent) for agent in sessions]
+    return {
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'sessions': len(sessions),
+        'failed_sessions': len(failed),
+        'sessions_per_second': len(sessions) / elapsed,
+        'gradings_per_second': (len(timings.get('grade', [])) + len(timings.get('revision', []))) / elapsed,
+        'steps': {name: {'runs': len(timings[name]),
+                         'p50': percentile(timings[name], 50),
+                         'p95': percentile(timings[name], 95),
+                         'p99': percentile(timings[name], 99),
+                         'max': max(timings[name])} for name in STEPS if name in timings},
+        'llm_calls': {template: count - calls.get(template, 0) for template, count in end_calls.items()
+                      if count > calls.get(template, 0)},
+        'queueing': {
+            'mean_wait_seconds': queue_waits,
+            'scheduler': {priority: {'granted': values['granted'] - scheduler_start[priority]['granted'],
+                                     'wait_seconds': values['wait_seconds'] - scheduler_start[priority]['wait_seconds'],
+                                     'max_queue_depth': values['max_queue_depth']}
+                          for priority, values in scheduler_end.items()},
+        },
+        'memory': {
+            'bytes_per_session': sum(sizes) / len(sizes) if sizes else None,
+            'peak_rss_mb': peak_rss_mb(),
+        },
+    }
+
+
+def print_summary(levels):
+    print(f'{"sessions":>8} {"sess/s":>7} {"failed":>6} ' + ' '.join(f'{name + " p95":>13}' for name in STEPS) +
+          f' {"KB/session":>10}', file=sys.stderr)
+    for level in levels:
+        steps = ' '.join(f'{level["steps"].get(name, {}).get("p95") or 0:13.2f}' for name in STEPS)
+        print(f'{level["concurrency"]:>8} {level["sessions_per_second"]:7.2f} {level["failed_sessions"]:>6} {steps} '
+              f'{(level["memory"]["bytes_per_session"] or 0) / 1024:10.1f}', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate concurrent student sessions against the grading pipeline '
+                                                 'on the local stand-in LLM, and report throughput, latency, '
+                                                 'queueing and memory as JSON as the concurrency ramps up.')
+    parser.add_argument('--concurrency', default='1,5,10,25,50',
+                        help='comma-separated numbers of concurrent sessions to ramp through')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run each concurrency level for')
+    parser.add_argument('--think-time', type=float, default=2, help='mean seconds that students wait between steps')
+    parser.add_argument('--grades', default=','.join(GRADES), help='comma-separated grades that students choose from')
+    parser.add_argument('--topics', default='baseball',
+                        help='comma-separated topics that students choose from (the canned essays are on baseball)')
+    parser.add_argument('--no-test-prefetch', dest='prefetch_test_essays', action='store_false',
+                        help="don't generate the test essays in the background, as the page does")
+    parser.add_argument('--no-rate-limits', action='store_true',
+                        help='ignore the OpenAI rate limits that the scheduler keeps to')
+    parser.add_argument('--rubric-store', help='directory of stored rubrics (defaults to an empty one, as on a '
+                                               'fresh deployment)')
+    parser.add_argument('--latency', type=float, default=2.0, help='mean LLM latency in seconds')
+    parser.add_argument('--jitter', type=float, default=1.5, help='LLM latency standard deviation')
+    parser.add_argument('--distribution', choices=('normal', 'lognormal'), default='lognormal',
+                        help='distribution of the LLM latency')
+    parser.add_argument('--tokens-per-second', type=float, default=0, help='LLM generation speed, 0 for instant')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of bad LLM outputs')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', help='file to write the report to (defaults to stdout)')
+    args = parser.parse_args()
+    args.grades = [grade.strip() for grade in args.grades.split(',')]
+    args.topics = [topic.strip() for topic in args.topics.split(',')]
+
+    rubric_store.directory = args.rubric_store or tempfile.mkdtemp(prefix='load-test-rubrics-')
+    # the stand-in's completion sizes say nothing about the real models', so keep them out of the caps file
+    token_caps.path = os.path.join(tempfile.mkdtemp(prefix='load-test-token-caps-'), 'token_caps.json')
+    scheduler = Scheduler(None, None) if args.no_rate_limits else default_scheduler
+    llm = LocalLLM(args.latency, args.jitter, args.failure_rate, args.tokens_per_second, args.seed, args.distribution)
+    # one core for the whole process, as the Streamlit page shares it between sessions
+    core = AgentCore(None, llm, scheduler)
+
+    levels = []
+    # the Agent logs its progress with print(), so keep that out of the report on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        for seed, concurrency in enumerate(int(value) for value in args.concurrency.split(',')):
+            print(f'running {concurrency} concurrent sessions for {args.duration:.0f}s')
+            levels.append(run_level(core, scheduler, concurrency, args, args.seed + seed))
+    print_summary(levels)
+
+    report = {'config': {key: value for key, value in vars(args).items() if key != 'output'}, 'levels': levels}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import guidance
+from guidance.llms._llm import LLMSession, SyncSession
+from template_kinds import template_kind
+import test_data
+
+RUBRIC_SECTIONS = ('Addressing the Topic', 'Organization', 'Grammar and Conventions', 'Vocabulary',
+                   'Development with Support/Evidence')
+LEVELS = ('Beginning', 'Developing', 'Proficient', 'Advanced')
+TEST_ESSAYS = {'low': test_data.baseball_poor, 'medium': test_data.baseball_fair, 'high': test_data.baseball_excellent}
+
+
+def _find(pattern, prompt, default=''):
+    match = re.search(pattern, prompt, re.DOTALL)
+    return match.group(1).strip() if match else default
+
+
+def _block_after(heading, prompt):
+    # the templates put their variables in ``` blocks right after a heading line
+    return _find(re.escape(heading) + r'\s*```\n(.*?)\n```', prompt)
+
+
+def _essay_score(essay):
+    words = len(essay.split())
+    return 0 if words < 40 else 1 if words < 100 else 2 if words < 300 else 3
+
+
+def _validity(prompt):
+    essay = _block_after('This is the essay:', prompt)
+    valid = len(essay.split()) >= 10
+    feedback = ('Your essay responds to the prompt and uses information from its context.' if valid else
+                'Your essay is too short to respond to the prompt. Write several sentences that answer the '
+                'question, using facts from the context.')
+    return {'valid': valid, 'feedback': feedback}
+
+
+def _grading(prompt):
+    essay = _block_after('This is the essay:', prompt)
+    previous = _block_after("This is the student's previous essay, or the changes from it to this essay:", prompt)
+    try:
+        sections = [section['section'] for section in json.loads(_block_after('This is the rubric:', prompt))]
+    except Exception:
+        sections = list(RUBRIC_SECTIONS)
+    score = _essay_score(essay)
+    table = '| Criteria | Score | Comments |\n| --- | --- | --- |\n'
+    for section in sections:
+        table += f'| {section} | {score} | You showed {LEVELS[score].lower()} skill in {section.lower()}. |\n'
+    comparison = ''
+    if previous.startswith(('Previous grading:', 'Changes')):
+        # the changes since the previous essay, with its grading when the Agent has it
+        previous_total = _find(r'"total": (\d+)', previous)
+        improved = previous_total and score * len(sections) > int(previous_total)
+        comparison = f'This essay {"improved on" if improved else "revises"} your previous essay.'
+    elif len(previous.split()) > 10:
+        change = 'improved on' if score > _essay_score(previous) else 'is similar to'
+        comparison = f'This essay {change} your previous essay.'
+    return {'table': table, 'total': score * len(sections),
+            'summary': f'Your essay shows {LEVELS[score].lower()} writing skills for your grade.',
+            'comparison': comparison}
+
+
+def canned_response(prompt):
+    kind = template_kind(prompt)
+    grade = _find(r'by a (\w+)-grade', prompt, 'Fourth')
+
+    if kind == 'rubric':
+        return json.dumps([{
+            'section': section,
+            'criteria': [{'description': f'{LEVELS[score]} {section.lower()} for a {grade}-grade student.',
+                          'score': score} for score in range(4)]
+        } for section in RUBRIC_SECTIONS], indent=2)
+
+    if kind == 'question':
+        topic = _find(r'on the topic of (.*?)\.(?:\s|<\||$)', prompt, 'the topic')
+        return (f'#### Introduction\nYou are to write an essay on the subject of {topic}. The following section '
+                f'contains important information that you are to use in your essay, and following that is the '
+                f'question that you are to address in your essay:\n\n'
+                f'#### Context\n{topic.capitalize()} is enjoyed by many people around the world. It takes skill, '
+                f'practice and teamwork, and people who take part in {topic} learn to plan ahead, stay focused '
+                f'and communicate with each other.\n\n'
+                f'Many communities have clubs and events for {topic}, which bring families and friends together.'
+                f'\n\n#### Question\nThink about the skills and qualities that are important in {topic}. Write an '
+                f'essay explaining how these skills and qualities can be helpful in other areas of your life. '
+                f'Use evidence from the context to support your essay.')
+
+    if kind == 'validity':
+        return json.dumps(_validity(prompt), indent=2)
+
+    if kind == 'grading':
+        return json.dumps(_grading(prompt), indent=2)
+
+    if kind == 'fused_grading':
+        validity = _validity(prompt)
+        if not validity['valid']:
+            return json.dumps({**validity, 'table': '', 'total': 0, 'summary': '', 'comparison': ''}, indent=2)
+        return json.dumps({**validity, **_grading(prompt)}, indent=2)
+
+    if kind == 'grading_qa':
+        return json.dumps({'valid': True, 'feedback': ''}, indent=2)
+
+    if kind == 'test':
+        return TEST_ESSAYS.get(_find(r'skill level of "(\w+)"', prompt).lower(), test_data.baseball_good)
+
+    return ''
+
+
+# Local stand-in for the OpenAI backend, which answers every template in main.py with canned but
+# schema-valid output after a configurable delay, so the pipeline can be exercised without an API key.
+class LocalLLM(guidance.llms.LLM):
+    llm_name = 'local'
+
+    def __init__(self, latency=0.5, jitter=0.2, failure_rate=0.0, tokens_per_second=0, seed=None,
+                 distribution='normal'):
+        super().__init__()
+        self.chat_mode = True
+        self.model_name = 'local'
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.failure_rate = failure_rate
+        self.tokens_per_second = tokens_per_second
+        self.random = random.Random(seed)
+        self._tokenizer = CharTokenizer()
+
+    def session(self, asynchronous=False):
+        if asynchronous:
+            return LocalSession(self)
+        else:
+            return SyncSession(LocalSession(self))
+
+    def role_start(self, role_name, **kwargs):
+        return '<|im_start|>' + role_name + ''.join([f' {k}="{v}"' for k, v in kwargs.items()]) + '\n'
+
+    def role_end(self, role_name=None):
+        return '<|im_end|>'
+
+    def complete(self, prompt, max_tokens):
+        # a failed call answers with prose instead of the requested output, or puts prose in front of it,
+        # like the real model sometimes does
+        if self.random.random() < self.failure_rate:
+            if self.random.random() < 0.5:
+                text = "I'm sorry, but I can't help with that request."
+            else:
+                text = 'Sure! Here is what you asked for:\n\n' + canned_response(prompt)
+        else:
+            text = canned_response(prompt)
+
+        # roughly 4 characters per token
+        finish_reason = 'stop'
+        if max_tokens and len(text) > max_tokens * 4:
+            text = text[:max_tokens * 4]
+            finish_reason = 'length'
+        return text, finish_reason
+
+    def delay(self):
+        if self.distribution == 'lognormal' and self.latency > 0:
+            # the same mean and standard deviation, but with the long tail of slow calls that the real API has
+            sigma = math.sqrt(math.log(1 + (self.jitter / self.latency) ** 2))
+            return self.random.lognormvariate(math.log(self.latency) - sigma ** 2 / 2, sigma)
+        return max(0.0, self.random.gauss(self.latency, self.jitter))
+
+    def token_delay(self):
+        return 1 / self.tokens_per_second if self.tokens_per_second else 0
+
+
+class LocalSession(LLMSession):
+    async def __call__(self, prompt, max_tokens=1000, stream=None, **kwargs):
+        text, finish_reason = self.llm.complete(prompt, max_tokens)
+        await asyncio.sleep(self.llm.delay())
+        if stream:
+            return self._stream(text, finish_reason)
+        await asyncio.sleep(len(text) / 4 * self.llm.token_delay())
+        return {'choices': [{'text': text, 'finish_reason': finish_reason}]}
+
+    async def _stream(self, text, finish_reason):
+        for pos in range(0, len(text), 4):
+            await asyncio.sleep(self.llm.token_delay())
+            last = pos + 4 >= len(text)
+            yield {'choices': [{'text': text[pos:pos + 4], 'finish_reason': finish_reason if last else None}]}
+
+
+class CharTokenizer:
+    def encode(self, text, **kwargs):
+        return [ord(c) for c in text]
+
+    def decode(self, ids, **kwargs):
+        return ''.join(chr(i) for i in ids)
+
+
+async def serve(llm, host, port):
+    # answers OpenAI chat completion requests, so the real OpenAI backend can be pointed at it with
+    # guidance.llms.OpenAI('gpt-4', rest_call=True, endpoint='http://<host>:<port>/v1/chat/completions')
+    from aiohttp import web
+
+    async def chat_completions(request):
+        data = await request.json()
+        prompt = '\n'.join(message['content'] for message in data['messages'])
+        text, finish_reason = llm.complete(prompt, data.get('max_tokens'))
+        await asyncio.sleep(llm.delay())
+        created = int(time.time())
+
+        if not data.get('stream'):
+            await asyncio.sleep(len(text) / 4 * llm.token_delay())
+            return web.json_response({
+                'id': f'local-{created}', 'object': 'chat.completion', 'created': created, 'model': data['model'],
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text},
+                             'finish_reason': finish_reason}],
+                'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(text) // 4,
+                          'total_tokens': (len(prompt) + len(text)) // 4},
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for pos in range(0, len(text), 4):
+            await asyncio.sleep(llm.token_delay())
+            last = pos + 4 >= len(text)
+            chunk = {'id': f'local-{created}', 'object': 'chat.completion.chunk', 'created': created,
+                     'model': data['model'], 'choices': [{'index': 0, 'delta': {'content': text[pos:pos + 4]},
+                                                          'finish_reason': finish_reason if last else None}]}
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+        await response.write(b'data: [DONE]\n\n')
+        return response
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    app.router.add_post('/chat/completions', chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f'serving local LLM on http://{host}:{port}/v1/chat/completions')
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the local stand-in LLM as an OpenAI-compatible server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.5, help='mean seconds before the first token')
+    parser.add_argument('--jitter', type=float, default=0.2, help='standard deviation of the latency in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of calls that return bad output')
+    parser.add_argument('--tokens-per-second', type=float, default=0, help='generation speed, 0 for instant')
+    parser.add_argument('--seed', type=int, default=None, help='random seed, for reproducible runs')
+    parser.add_argument('--distribution', choices=('normal', 'lognormal'), default='normal',
+                        help='distribution of the latency, lognormal for a long tail of slow calls')
+    args = parser.parse_args()
+    llm = LocalLLM(args.latency, args.jitter, args.failure_rate, args.tokens_per_second, args.seed,
+                   args.distribution)
+    asyncio.run(serve(llm, args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
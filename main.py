@@ -1,10 +1,35 @@
+import asyncio
 from asyncio import (set_event_loop, new_event_loop, run)
+from collections import OrderedDict
+import hashlib
 import os
-import guidance
-import streamlit as st
+import random
+import re
+import threading
+import time
+import nest_asyncio
 import json
-import test_data
 import traceback
+from types import SimpleNamespace
+import essay_prefetch
+import metrics
+import prescreen
+import revision
+import routing
+import upstream
+from token_caps import token_caps, finish_reasons, TruncatedError, TRUNCATION_FRACTION
+from json_stream import JSONStreamError, JSONStreamParser
+from question_cache import question_cache
+from rubric_store import rubric_store, check_rubric, check_rubric_section, compact_rubric
+from score_validator import SCORE_FIELDS, check_score, check_score_field
+from scheduler import Scheduler, scheduler as default_scheduler, INTERACTIVE, BACKGROUND
+
+QUALITIES = ('Low', 'Medium', 'High')
+GRADES = ('First', 'Second', 'Third', 'Fourth', 'Fifth', 'Sixth', 'Seventh', 'Eighth',
+          'Ninth', 'Tenth', 'Eleventh', 'Twelfth')
+
+# number of graded submissions that each session keeps results for
+MAX_CACHED_RESULTS = 20
 
 rubric_prompt = """
 {{#system~}}
@@ -12,9 +37,8 @@ You are an expert in writing rubrics for grading essays written by elementary sc
 {{~/system}}
 
 {{#user~}}
-Create a rubric for grading an essay written by a {{grade}}-grade student.
-The rubric should be based on these standards: {{standard}}.
-The rubric should be specific to the standards for the {{grade}} grade.
+Create a rubric for grading an essay written by a student in the grade given below, based on the standards
+given below. The rubric should be specific to the standards for the student's grade.
 
 The only output you produce should be a JSON array of objects, each of which has the following fields:
  - "section": A short title for the section of the criteria.
@@ -78,10 +102,13 @@ This is an example for two sections of the rubric:
     ]
   }
 ]
+
+The essay will be written by a {{grade}}-grade student, and the rubric should be based on these standards:
+{{standard}}
 {{~/user}}
 
 {{#assistant~}}
-{{gen 'rubric' temperature=0 max_tokens=5000}}
+{{gen 'rubric' temperature=0 max_tokens=token_limit}}
 {{~/assistant}}
 """
 
@@ -92,14 +119,11 @@ You should always use age-appropriate language and be sure not to include any in
 {{~/system}}
 
 {{#user~}}
-Create a free-response essay prompt for a {{grade}}-grade student on the topic of {{topic}}.
+Create a free-response essay prompt for a student in the grade and on the topic given below.
 Make sure that it uses age-appropriate language and subject matter.
 
-The student's resulting essay must be able to be graded against this rubric, which is formatted as a JSON array,
-with several sections that each have a set of Criteria, which when satisfied are given the corresponding Score:
-```
-{{rubric}}
-```
+The student's resulting essay must be able to be graded against the rubric given below, which is formatted as a JSON
+array of sections, each with a "criteria" object that maps every Score to the Criteria that is given that Score.
 
 Your prompt output consists of three distinct sections: the Introduction, Context, and Question.
 Each section is marked by a heading with its section name, separated from the previous section by
@@ -150,10 +174,17 @@ Overall, golf is an exciting and challenging game that can be enjoyed by people
 #### Question
 Think about the skills and qualities that are important in the game of golf, such as patience, strategy, and concentration. Write an essay explaining how these skills and qualities can be helpful in other areas of your life. Use evidence from the context to support your essay. Remember to include an introduction, body paragraphs with supporting details, and a conclusion. Use clear language and proper grammar, punctuation, and capitalization.
 ```
+
+This is the rubric:
+```
+{{rubric}}
+```
+
+The essay prompt is for a {{grade}}-grade student on the topic of {{topic}}.
 {{~/user}}
 
 {{#assistant~}}
-{{gen 'question' temperature=0 max_tokens=5000}}
+{{gen 'question' temperature=0 max_tokens=token_limit}}
 {{~/assistant}}
 """
 
@@ -164,11 +195,11 @@ You should always use age-appropriate language and be sure not to include any in
 {{~/system}}
 
 {{#user~}}
-You are grading an essay from a {{grade}}-grade student that was submitted in response to the prompt.
+You are grading an essay from a student that was submitted in response to the prompt given below.
 In all your output, use the second-person singular to address your feedback directly to the student.
 
 Your only task at this stage is to verify whether the content of the essay is directly responsive to the prompt,
-and that its subject matches the given topic: "{{topic}}".
+and that its subject matches the prompt's topic.
 
 The essay should be directly responsive to the prompt, use information contained in the prompt's context,
 and conform to its guidance.
@@ -185,19 +216,19 @@ Example output:
 }
 ```
 
-This is the essay:
+The essay was submitted in response to this prompt, on the topic of "{{topic}}":
 ```
-{{essay}}
+{{question}}
 ```
 
-The essay was submitted in response to this prompt:
+The essay is from a {{grade}}-grade student. This is the essay:
 ```
-{{question}}
+{{essay}}
 ```
 {{~/user}}
 
 {{#assistant~}}
-{{gen 'result' temperature=0 max_tokens=2000}}
+{{gen 'result' temperature=0 max_tokens=token_limit}}
 {{~/assistant}}
 """
 
@@ -211,12 +242,12 @@ You should always use age-appropriate language and be sure not to include any in
 {{~/system}}
 
 {{#user~}}
-You are given an assessment that asks you to score an essay from a {{grade}}-grade student.
+You are given an assessment that asks you to score an essay from a student.
 You need to use this assessment to prove that you are an excellent scorer of essays.
 
-Use the rubric given below to score the essay. The rubric  is formatted as a JSON array,
-with several sections that each have a set of Criteria, which when satisfied are given the corresponding Score
-for that section.
+Use the rubric given below to score the essay. The rubric is formatted as a JSON array
+of sections, each with a "criteria" object that maps every Score to the Criteria that, when satisfied, is given
+that Score for the section.
 The essay is to be given a Score for each section of the rubric, based on the highest of the section's
 Criteria that it has satisfied.
 
@@ -244,34 +275,35 @@ that contains:
  - "summary": A short summary of the grading, of no more than 4 sentences, that highlights the key strengths
    and weaknesses of the student's essay.
 
- - "comparison": If the following text, which is the content of the student's previous essay,
-  is more than 10 words long:
-```
-{{previous_essay}}
-```
-  then this field is a summary comparison of the student's current essay with their previous essay, otherwise
-  it is an empty string.
+ - "comparison": If the student's previous essay, or the changes from it to this essay, are given below, then this
+  field is a summary comparison of no more than 2 sentences of the student's current essay with their previous
+  essay, otherwise it is an empty string.
 
-This is the rubric:
+Don't include the actual text of the rubric in the grading output.
+
+The essay is from a {{grade}}-grade student. This is the rubric:
 ```
 {{rubric}}
 ```
 
-This is the essay:
+The essay was submitted in response to this prompt:
 ```
-{{essay}}
+{{question}}
 ```
 
-The essay was submitted in response to this prompt:
+This is the student's previous essay, or the changes from it to this essay:
 ```
-{{question}}
+{{revision}}
 ```
 
-Don't include the actual text of the rubric in the grading output.
+This is the essay:
+```
+{{essay}}
+```
 {{~/user}}
 
 {{#assistant~}}
-{{gen 'grade' temperature=0 max_tokens=5000}}
+{{gen 'score' temperature=0 max_tokens=token_limit}}
 {{~/assistant}}
 """
 
@@ -281,10 +313,7 @@ You are an experienced educator who is an expert at evaluating the grading of ot
 {{~/system}}
 
 {{#user~}}
-You are to evaluate the quality of the following grading that was produced by a {{grade}}-grade teacher:
-```
-{{score}}
-```
+You are to evaluate the quality of the grading given below, that was produced by a teacher.
 The grading is formatted as a JSON object with the following fields:
  - "table": A markdown table that has a row for each section of the grading rubric that was used. Each row contains:
    - A "Criteria" column with the name of the section of the rubric.
@@ -292,7 +321,7 @@ The grading is formatted as a JSON object with the following fields:
    - A "Comments" column that summarizes the reasons why they gave the student the given Score for that Criteria, and
      if the score is less than 3, tells the student what they could do to improve it.
 
- - "total": The student's total Score points, out of a maximum of {{max_score}}.
+ - "total": The student's total Score points, out of the maximum score given below.
 
  - "summary": A short summary of the grading that highlights the key strengths and weaknesses of the student's essay.
 
@@ -314,25 +343,117 @@ Example output:
 }
 
 Do not include any content in your output other than the JSON object.
+
+The grading was produced by a {{grade}}-grade teacher, and the maximum score is {{max_score}}. This is the grading:
+```
+{{score}}
+```
 {{~/user}}
 
 {{#assistant~}}
-{{gen 'result' temperature=0 max_tokens=5000}}
+{{gen 'result' temperature=0 max_tokens=token_limit}}
 {{~/assistant}}
 """
 
-test_prompt = """
+fused_grading_prompt = """
 {{#system~}}
-You are student simulator that can simulate the writing output of students with different levels of skill.
+You are a highly qualified candidate applying for an elementary-school teaching position at a school
+with very high standards.
+You need to prove to the school that you have excellent skills, especially when it comes to scoring
+writing assignments.
+You should always use age-appropriate language and be sure not to include any inappropriate details or feedback.
 {{~/system}}
 
 {{#user~}}
-You are to write an essay that would be produced by a {{grade}}-grade student, with a skill level of "{{quality}}".
-The essay is supposed to be in response to this prompt question, but for "low" and "medium" skill levels
-it shouldn't be fully responsive to it:
+You are given an assessment that asks you to check and score an essay from a student.
+You need to use this assessment to prove that you are an excellent scorer of essays.
+In all your output, use the second-person singular to address your feedback directly to the student.
+
+First verify whether the content of the essay is directly responsive to the prompt, and that its subject
+matches the prompt's topic. The essay should be directly responsive to the prompt, use information
+contained in the prompt's context, and conform to its guidance.
+
+If the essay is valid, then use the rubric given below to score it. The rubric is formatted as a JSON array
+of sections, each with a "criteria" object that maps every Score to the Criteria that, when satisfied, is given
+that Score for the section.
+The essay is to be given a Score for each section of the rubric, based on the highest of the section's
+Criteria that it has satisfied.
+
+Work on the grading step-by-step to be sure that each section of the rubric has been scored accurately.
+For each of the sections in the rubric, choose the Score for the one row whose Criteria most closely
+applies to the essay. Make sure that you are correctly applying the Criteria
+and getting the right Score. For every scoring decision, ask yourself whether a higher or lower score
+in that section would make more sense.
+
+Be strict in your grading, requiring that the rubric's Criteria really is met in order to assign its Score.
+
+Before you produce your output, check your grading for any problems, and fix them if there are any:
+ - The comments in the scoring table being in conflict with, or not related to, the criteria.
+ - The summary being in conflict with, or not related to, the comments in the scoring table.
+ - The comparison, if it exists, being in conflict with, or not related to, the summary.
+ - The total not being the sum of the scores in the table.
+
+The only output you produce should be a JSON object with the following fields:
+ - "valid": A boolean field that indicates whether the essay is directly responsive to the prompt and its topic.
+
+ - "feedback": A single paragraph of no more than 6 sentences that describes exactly how the essay is or isn't
+   valid, and suggests how it could be made to be if it isn't.
+
+ - "table": If the essay is valid, a markdown table, with no heading. For each section in the rubric, the table
+   has a row that contains:
+   - A "Criteria" column with the name of the section of the rubric.
+   - A "Score" column with the score that you assigned for that section.
+   - A "Comments" column that summarizes the reasons why you gave the student the given Score for that Criteria, and
+     if the score is less than 3, tells the student what they could do to improve it.
+  Only include one Score row for each section of the rubric. If the essay isn't valid this is an empty string.
+
+ - "total": The student's total Score points, or 0 if the essay isn't valid.
+
+ - "summary": If the essay is valid, a short summary of the grading, of no more than 4 sentences, that highlights
+   the key strengths and weaknesses of the student's essay, otherwise an empty string.
+
+ - "comparison": If the essay is valid and the student's previous essay, or the changes from it to this essay, are
+  given below, then this field is a summary comparison of no more than 2 sentences of the student's current essay
+  with their previous essay, otherwise it is an empty string.
+
+Don't include the actual text of the rubric in the grading output.
+
+The essay is from a {{grade}}-grade student. This is the rubric:
+```
+{{rubric}}
+```
+
+The essay was submitted in response to this prompt, on the topic of "{{topic}}":
 ```
 {{question}}
 ```
+
+This is the student's previous essay, or the changes from it to this essay:
+```
+{{revision}}
+```
+
+This is the essay:
+```
+{{essay}}
+```
+{{~/user}}
+
+{{#assistant~}}
+{{gen 'result' temperature=0 max_tokens=token_limit}}
+{{~/assistant}}
+"""
+
+test_prompt = """
+{{#system~}}
+You are student simulator that can simulate the writing output of students with different levels of skill.
+{{~/system}}
+
+{{#user~}}
+You are to write an essay that would be produced by a student with the grade and skill level given below.
+The essay is supposed to be in response to the prompt question given below, but for "low" and "medium" skill levels
+it shouldn't be fully responsive to it.
+
 A "low" skill essay should use simple sentence structures and limited vocabulary, have straightforward ideas,
 and use very poor grammar. It should only have one paragraph, and shouldn't include an introduction or conclusion. It should
 be on the topic of the prompt question, but it shouldn't include evidence from the context to support its statements.
@@ -342,7 +463,7 @@ errors. It should have no more than 2 paragraphs, and it should lack some of the
 question; for example, only include one piece of evidence from the context to support its statements.
 
 A "high" skill essay should use complex sentence structures and an extensive vocabulary. It should be written
-at a skill level that is 2-3 grades higher than {{grade}} grade. It should address all the themes and facts
+at a skill level that is 2-3 grades higher than the student's grade. It should address all the themes and facts
 presented in the context of the prompt question.
 
 Approach this in a step-by-step way to make sure that the essay you produce represents the given
@@ -350,159 +471,883 @@ skill level for the given grade.
 
 Your output should only be the content of the essay, in simple text, with no title or headings,
 and no mention of the skill level or the expected grading.
+
+The essay is by a {{grade}}-grade student, in response to this prompt question:
+```
+{{question}}
+```
+
+The essay should have a skill level of "{{quality}}".
 {{~/user}}
 
 {{#assistant~}}
-{{gen 'essay' temperature=0 max_tokens=2000}}
+{{gen 'essay' temperature=0 max_tokens=token_limit}}
 {{~/assistant}}
 """
 
-class Agent:
-    def __init__(self, api_key):
-        self.standard = 'Common Core State Standards for English Language Arts & Literacy: CCSS.ELA-LITERACY.W.4.9'
-        self.max_tries = 5
+# the most completion tokens that each template's output can take, which its calls are capped below once the
+# sizes of its outputs are known
+TEMPLATE_MAX_TOKENS = {'rubric': 5000, 'question': 5000, 'validity': 2000, 'grading': 5000, 'grading_qa': 5000,
+                       'fused_grading': 5000, 'test': 2000}
 
-        self.grade = None
-        self.rubric = None
-        self.max_score = None
-        self.topic = None
-        self.question = None
+template_prompts = {'rubric': rubric_prompt, 'question': question_prompt, 'validity': validity_prompt,
+                    'grading': grading_prompt, 'grading_qa': grading_qa_prompt, 'fused_grading': fused_grading_prompt,
+                    'test': test_prompt}
 
-        # init the Guidance templates
-        guidance.llm = guidance.llms.OpenAI("gpt-4", api_key=api_key, max_retries=20)
+class QARejectedError(Exception):
+    pass
 
-        self.rubric_template = guidance(rubric_prompt)
-        self.question_template = guidance(question_prompt)
-        self.validity_template = guidance(validity_prompt)
-        self.grading_template = guidance(grading_prompt)
-        self.grading_qa_template = guidance(grading_qa_prompt)
-        self.test_template = guidance(test_prompt)
 
-    def generate_rubric(self, grade):
-        self.grade = grade
-        self.rubric = None
+class UpstreamError(Exception):
+    pass
+
+
+def failure_reason(exc):
+    if isinstance(exc, upstream.DeadlineExceededError):
+        return metrics.DEADLINE
+    if isinstance(exc, upstream.CircuitOpenError):
+        return metrics.CIRCUIT_OPEN
+    if isinstance(exc, JSONStreamError):
+        return exc.reason
+    if isinstance(exc, json.JSONDecodeError):
+        return metrics.JSON_PARSE
+    if isinstance(exc, QARejectedError):
+        return metrics.QA_REJECTED
+    if isinstance(exc, UpstreamError):
+        return metrics.UPSTREAM
+    return metrics.SANITY_CHECK
+
+
+def prompt_tokens(template, **kwargs):
+    # roughly 4 characters per token
+    return (len(template.text) + sum(len(str(value)) for value in kwargs.values())) // 4
+
+
+def generated_text(template, program):
+    return ''.join(str(program.get(name) or '') for name in re.findall(r"{{gen '(\w+)'", template.text))
+
+
+def completion_tokens(template, program):
+    return len(generated_text(template, program)) // 4
+
+
+def estimate_tokens(template, token_limit, **kwargs):
+    # all the completion tokens that the call is allowed count against the rate limit too
+    return prompt_tokens(template, **kwargs) + token_limit
+
+
+def check_validity_field(path, value):
+    if path == ('valid',) and not isinstance(value, bool):
+        raise Exception(f'validity field "valid" isn\'t a boolean: {value}')
+    if path == ('feedback',) and not isinstance(value, str):
+        raise Exception(f'validity field "feedback" isn\'t a string: {value}')
+
+
+def rubric_parser():
+    # each section of the rubric is checked as soon as it has been generated
+    return JSONStreamParser(list, lambda path, value: check_rubric_section(value) if len(path) == 1 else None)
+
+
+def validity_parser():
+    return JSONStreamParser(dict, check_validity_field)
+
+
+def score_parser(rubric):
+    return JSONStreamParser(dict, lambda path, value: check_score_field(path[0], value, rubric)
+                            if len(path) == 1 else None)
+
+
+def fused_parser(rubric):
+    # the grading fields only have to pass the checks when the essay is valid
+    valid = []
+
+    def check(path, value):
+        if len(path) == 1:
+            check_validity_field(path, value)
+            if path == ('valid',):
+                valid.append(value)
+            elif valid and valid[0]:
+                check_score_field(path[0], value, rubric)
+
+    return JSONStreamParser(dict, check)
+
+
+def check_fused(result_str, rubric, max_score):
+    # splits the fused output into the same validity and score that check_valid and score return
+    result = json.loads(result_str)
+    if not isinstance(result.get('valid'), bool) or not isinstance(result.get('feedback'), str):
+        raise Exception(f'invalid validity in fused grading: {result}')
+    validity = {'valid': result['valid'], 'feedback': result['feedback']}
+    if not validity['valid']:
+        return validity, None
+    return validity, check_score({field: result[field] for field in SCORE_FIELDS if field in result},
+                                 rubric, max_score)
+
+
+# the part of the grader that every session can share: the LLM backends, the compiled templates and the
+# scheduler, with no state of its own, so each call is passed the session's grade, rubric, topic and question
+class AgentCore:
+    def __init__(self, api_key, llm=None, scheduler=None, fused=None, routes=None, llms=None):
+        self.standard = 'Common Core State Standards for English Language Arts & Literacy: CCSS.ELA-LITERACY.W.4.9'
+        self.max_tries = 5
+        self.scheduler = scheduler or default_scheduler
+        # which models each template is run on, each model with its own circuit breaker
+        self.router = routing.Router(routes or routing.routes_from_env())
+        self.hedge_percentile = upstream.HEDGE_PERCENTILE
+        # fraction of gradings that are also audited by the LLM QA template, on top of the local checks
+        self.qa_sample_rate = float(os.environ.get('GRADING_QA_SAMPLE_RATE', 0))
+        # give the grading templates the changes since the previous essay and how it was graded, rather than
+        # the whole previous essay, and compare the section scores with the previous grading's locally
+        self.compact_revisions = os.environ.get('COMPACT_REVISIONS', '1') not in ('', '0')
+        # check validity and score an essay with a single fused LLM call instead of one call for each
+        self.fused = os.environ.get('FUSED_GRADING', '') not in ('', '0') if fused is None else fused
+
+        # the LLM backends and the compiled Guidance templates are only made once a template is first run, so
+        # that importing this and rendering a stored rubric don't wait for guidance, OpenAI's client and the
+        # template compilation
+        self.api_key = api_key
+        self._llm = llm
+        self._given_llms = llms or {}
+        self._given_scheduler = scheduler
+        self._llms = None
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    @property
+    def llms(self):
+        # the backend of each model that the templates are routed to: the one given for the model, the one given
+        # for every model, or OpenAI's, with the completion cache in front if one is configured
+        with self._lock:
+            if self._llms is None:
+                import guidance
+                import completion_cache
+                llms = {model: self._given_llms.get(model) or self._llm or
+                        guidance.llms.OpenAI(model, api_key=self.api_key, max_retries=3, caching=False)
+                        for model in self.router.models}
+                # the wrapper also tells the calls how their completions finished, cut off by their cap or not
+                cache, cache_mode = completion_cache.from_env()
+                llms = {model: completion_cache.CachingLLM(model_llm, cache, cache_mode or completion_cache.CACHE)
+                        for model, model_llm in llms.items()}
+                # replayed completions never reach the API, so there are no rate limits to keep within
+                if cache_mode == completion_cache.REPLAY and not self._given_scheduler:
+                    self.scheduler = Scheduler(None, None)
+                self._llms = llms
+            return self._llms
+
+    @property
+    def llm(self):
+        # the backend of the model that grades the essays
+        return self.llms[self.router.primary('grading')]
+
+    def template(self, name, model):
+        # each template is compiled the first time that it is run on the model
+        key = (name, model)
+        if key not in self._templates:
+            import guidance
+            llm = self.llms[model]
+            with self._lock:
+                if key not in self._templates:
+                    self._templates[key] = guidance(template_prompts[name], llm=llm)
+        return self._templates[key]
+
+    def has_spare_capacity(self, name, calls, headroom):
+        # whether the calls of the template could be let through now and still leave headroom of the rate limits
+        model = self.router.routes[name]['models'][0]
+        tokens = (len(template_prompts[name]) // 4 +
+                  token_caps.cap(name, self.backend_name(model), TEMPLATE_MAX_TOKENS[name]))
+        return self.scheduler.has_spare(calls, calls * tokens, headroom)
+
+    def backend_name(self, model):
+        # the model name of the backend, without having to make it
+        llm = self._llms[model] if self._llms else self._given_llms.get(model) or self._llm
+        return llm.model_name if llm else model
+
+    def model_name(self, name):
+        # the model that the template is meant to run on, which rubrics and questions are stored under
+        return self.backend_name(self.router.primary(name))
+
+    def get_rubric(self, grade, priority=INTERACTIVE):
+        # rubrics only depend on the standard and grade, so share them across sessions and restarts
+        return rubric_store.get_or_create(self.standard, grade, rubric_prompt, self.model_name('rubric'),
+                                          lambda: self.create_rubric(grade, priority))
+
+    def create_rubric(self, grade, priority=INTERACTIVE):
+        rubric = None
         tries = 0
-        while not self.rubric and tries < self.max_tries:
+        trace = metrics.StageTrace('rubric')
+        deadline = upstream.Deadline('rubric')
+        while not rubric and tries < self.max_tries:
             try:
-                rubric_str = self.rubric_template(standard=self.standard, grade=grade)['rubric']
+                rubric_str = self._run('rubric', priority, retry=tries > 0, deadline=deadline,
+                                       make_parser=rubric_parser, standard=self.standard, grade=grade)['rubric']
                 # print(f'\nrubric = {rubric_str}')
-                self.rubric = json.loads(rubric_str)
+                rubric = json.loads(rubric_str)
 
                 # sanity-check rubric
-                self.max_score = len(self.rubric) * 3
-                if self.max_score == 0:
-                    raise Exception('rubric contains no sections')
-                for section in self.rubric:
-                    if len(section['criteria']) != 4:
-                        raise Exception(f'section doesn\'t have four criteria: {section}')
-                    score = 0
-                    for criteria in section['criteria']:
-                        if len(criteria['description']) == 0:
-                            raise Exception(f'missing description in criteria: {criteria}')
-                        score += criteria['score']
-                    if score != 6:
-                        raise Exception(f'incorrect scores in section: {section}')
+                check_rubric(rubric)
             except Exception as exc:
                 print(f'error getting rubric: {exc}')
-                self.rubric = None
+                trace.failed(failure_reason(exc))
+                rubric = None
                 tries += 1
-
-    def get_display_rubric(self):
-        if self.rubric:
-            table = '| Criteria | Score |\n| --- | --- |\n'
-            for section in self.rubric:
-                table += '| **' + section['section'] + '** |\n'
-                for criteria in section['criteria']:
-                    table += '| ' + criteria['description'] + ' | ' + str(criteria['score']) + ' |\n'
-            return table
-        else:
-            return None
-
-    def get_question(self, topic):
-        if not self.topic or self.topic != topic:
-            self.topic = topic
-            self.question = None
-            tries = 0
-            while not self.question and tries < self.max_tries:
-                try:
-                    while not self.question and tries < self.max_tries:
-                        question = self.question_template(grade=self.grade, topic=topic, rubric=self.rubric)['question']
-                        if question and 'Introduction' in question and 'Context' in question and 'Question' in question:
-                            self.question = question
-                        else:
-                            raise Exception(f'invalid question: {question}')
-                except Exception as exc:
-                    print(f'error getting question: {exc}')
-                    tries += 1
-        return self.question
-
-    def check_valid(self, essay):
-        validity = None
+                if not self._back_off(exc, tries, deadline):
+                    break
+        trace.done(rubric)
+        return rubric
+
+    def prefetch_questions(self, grade, rubric):
+        question_cache.prefetch(grade, rubric, self.model_name('question'),
+                                lambda topic: self.create_question(grade, rubric, topic, BACKGROUND))
+
+    def get_question(self, grade, rubric, topic, priority=INTERACTIVE):
+        # obviously unsuitable topics don't get a question generated for them, which is told apart from a
+        # question that couldn't be generated (None) by being empty
+        reason = prescreen.check_topic(topic)
+        if reason:
+            prescreen.record_rejection('topic', reason, prescreen.TOPIC_CALLS)
+            return ''
+        # questions only depend on the grade, topic and rubric, so share them across sessions
+        return question_cache.get_or_create(grade, topic, rubric, self.model_name('question'),
+                                            lambda topic: self.create_question(grade, rubric, topic, priority))
+
+    def create_question(self, grade, rubric, topic, priority=INTERACTIVE):
+        question = None
         tries = 0
+        trace = metrics.StageTrace('question')
+        deadline = upstream.Deadline('question')
+        while not question and tries < self.max_tries:
+            try:
+                question = self._run('question', priority, retry=tries > 0, deadline=deadline, grade=grade,
+                                     topic=topic, rubric=compact_rubric(rubric))['question']
+                if not (question and 'Introduction' in question and 'Context' in question and 'Question' in question):
+                    raise Exception(f'invalid question: {question}')
+            except Exception as exc:
+                print(f'error getting question: {exc}')
+                trace.failed(failure_reason(exc))
+                question = None
+                tries += 1
+                if not self._back_off(exc, tries, deadline):
+                    break
+        trace.done(question)
+        return question
+
+    def check_valid(self, session, essay):
+        return self._run_in_loop(self.check_valid_async(session, essay))
+
+    async def check_valid_async(self, session, essay):
+        validity = self._prescreen(session, essay, prescreen.VALIDITY_CALLS)
+        if validity:
+            return validity
+        tries = 0
+        trace = metrics.StageTrace('validity')
+        deadline = upstream.Deadline('validity')
         while not validity and tries < self.max_tries:
             try:
-                validity_str = self.validity_template(grade=self.grade, essay=essay, topic=self.topic,
-                                                      question=self.question)['result']
+                validity_str = (await self._run_async('validity', session.priority, retry=tries > 0,
+                                                      deadline=deadline, make_parser=validity_parser,
+                                                      grade=session.grade, essay=essay, topic=session.topic,
+                                                      question=session.question))['result']
                 validity = json.loads(validity_str)
             except Exception as exc:
                 print(f'error checking validity: {exc}')
+                trace.failed(failure_reason(exc))
                 tries += 1
+                if not await self._back_off_async(exc, tries, deadline):
+                    break
+        trace.done(validity)
         return validity
 
-    def score(self, essay, previous_essay):
+    def score(self, session, essay, previous_essay, on_partial=None):
+        return self._run_in_loop(self.score_async(session, essay, previous_essay, on_partial))
+
+    async def score_async(self, session, essay, previous_essay, on_partial=None):
+        revision_str, previous = self._revision(session, essay, previous_essay)
         score = None
         tries = 0
+        trace = metrics.StageTrace('score')
+        deadline = upstream.Deadline('score')
         while not score and tries < self.max_tries:
             try:
-                score_str = self.grading_template(rubric=self.rubric, grade=self.grade, essay=essay, topic=self.topic,
-                                              question=self.question, previous_essay=previous_essay)['grade']
-                # check the scoring for consistency and quality
-                qa_str = self.grading_qa_template(score=score_str, grade=self.grade, max_score=self.max_score)['result']
-                print(f'qa result = {qa_str}')
-                if qa_str:
-                    qa = json.loads(qa_str)
-                    if qa['valid']:
-                        score = json.loads(score_str)
-                    else:
-                        raise Exception(f"got qa error: {qa['feedback']}")
-                else:
-                    raise Exception('got no output from qa')
+                score_str = (await self._run_async('grading', session.priority, retry=tries > 0, deadline=deadline,
+                                                   on_partial=on_partial,
+                                                   make_parser=lambda: score_parser(session.rubric),
+                                                   rubric=compact_rubric(session.rubric), grade=session.grade,
+                                                   essay=essay, topic=session.topic, question=session.question,
+                                                   revision=revision_str))['score']
+                score = check_score(json.loads(score_str), session.rubric, session.max_score)
+                if random.random() < self.qa_sample_rate:
+                    # check the scoring for consistency and quality
+                    qa_str = (await self._run_async('grading_qa', session.priority, retry=tries > 0,
+                                                    deadline=deadline, score=score_str, grade=session.grade,
+                                                    max_score=session.max_score))['result']
+                    self._check_qa(qa_str)
             except Exception as exc:
                 print(f'error getting score: {exc}')
+                trace.failed(failure_reason(exc))
                 score = None
                 tries += 1
-        return score
-
-    def get_test_data(self, quality):
+                if not await self._back_off_async(exc, tries, deadline):
+                    break
+        trace.done(score)
+        return score and revision.compare(score, previous)
+
+    def grade_fused(self, session, essay, previous_essay, on_partial=None):
+        return self._run_in_loop(self.grade_fused_async(session, essay, previous_essay, on_partial))
+
+    async def grade_fused_async(self, session, essay, previous_essay, on_partial=None):
+        validity = self._prescreen(session, essay, prescreen.FUSED_ESSAY_CALLS)
+        if validity:
+            return validity, None
+        revision_str, previous = self._revision(session, essay, previous_essay)
+        score = None
+        tries = 0
+        trace = metrics.StageTrace('fused_grading')
+        deadline = upstream.Deadline('fused_grading')
+        while not validity and tries < self.max_tries:
+            try:
+                result_str = (await self._run_async('fused_grading', session.priority, retry=tries > 0,
+                                                    deadline=deadline, on_partial=on_partial,
+                                                    make_parser=lambda: fused_parser(session.rubric),
+                                                    rubric=compact_rubric(session.rubric), grade=session.grade,
+                                                    essay=essay, topic=session.topic, question=session.question,
+                                                    revision=revision_str))['result']
+                validity, score = check_fused(result_str, session.rubric, session.max_score)
+                if score and random.random() < self.qa_sample_rate:
+                    qa_str = (await self._run_async('grading_qa', session.priority, retry=tries > 0,
+                                                    deadline=deadline, score=json.dumps(score), grade=session.grade,
+                                                    max_score=session.max_score))['result']
+                    self._check_qa(qa_str)
+            except Exception as exc:
+                print(f'error getting fused grading: {exc}')
+                trace.failed(failure_reason(exc))
+                validity = score = None
+                tries += 1
+                if not await self._back_off_async(exc, tries, deadline):
+                    break
+        trace.done(validity)
+        return validity, score and revision.compare(score, previous)
+
+    async def grade_async(self, session, essay, previous_essay, on_partial=None):
+        if self.fused:
+            return await self.grade_fused_async(session, essay, previous_essay, on_partial)
+        validity = self._prescreen(session, essay, prescreen.ESSAY_CALLS)
+        if validity:
+            return validity, None
+
+        # most essays are valid, so start grading speculatively while the validity check runs,
+        # and throw the grading away if the essay turns out not to be
+        partial = []
+        valid = []
+
+        def score_partial(text):
+            # hold back the partial grading until we know that the essay is valid
+            partial[:] = [text]
+            if valid:
+                on_partial(text)
+
+        score_task = asyncio.ensure_future(self.score_async(session, essay, previous_essay,
+                                                            score_partial if on_partial else None))
+        try:
+            validity = await self.check_valid_async(session, essay)
+        except BaseException:
+            score_task.cancel()
+            raise
+        if not validity or not validity['valid']:
+            score_task.cancel()
+            await asyncio.gather(score_task, return_exceptions=True)
+            return validity, None
+        valid.append(True)
+        if on_partial and partial:
+            on_partial(partial[0])
+        return validity, await score_task
+
+    def get_test_data(self, session, quality, on_partial=None, priority=BACKGROUND):
+        return self._run_in_loop(self.get_test_data_async(session, quality, on_partial, priority))
+
+    async def get_test_data_async(self, session, quality, on_partial=None, priority=BACKGROUND):
         data = None
         tries = 0
+        trace = metrics.StageTrace('test')
+        deadline = upstream.Deadline('test')
         while not data and tries < self.max_tries:
             try:
-                data = self.test_template(grade=self.grade, quality=quality, question=self.question, rubric=self.rubric)['essay']
+                data = (await self._run_async('test', priority, retry=tries > 0, deadline=deadline,
+                                              on_partial=on_partial, grade=session.grade, quality=quality,
+                                              question=session.question))['essay']
             except Exception as exc:
                 print(f'error getting test data: {exc}')
+                trace.failed(failure_reason(exc))
                 tries += 1
+                if not await self._back_off_async(exc, tries, deadline):
+                    break
+        trace.done(data)
         return data
 
+    def _revision(self, session, essay, previous_essay):
+        # what the grading templates are given about the previous essay, and its grading if the session has it
+        if not self.compact_revisions:
+            return previous_essay, None
+        previous = session.previous_grading(previous_essay)
+        return revision.revision_context(previous_essay, essay, previous), previous
+
+    @staticmethod
+    def _prescreen(session, essay, saved_calls):
+        # answers obviously invalid essays straight away, with the same validity that the LLM check gives
+        rejection = prescreen.check_essay(essay, session.question)
+        if not rejection:
+            return None
+        reason, feedback = rejection
+        prescreen.record_rejection('essay', reason, saved_calls)
+        return {'valid': False, 'feedback': feedback}
+
+    @staticmethod
+    def _check_qa(qa_str):
+        print(f'qa result = {qa_str}')
+        if qa_str:
+            qa = json.loads(qa_str)
+            if not qa['valid']:
+                raise QARejectedError(f"got qa error: {qa['feedback']}")
+        else:
+            raise Exception('got no output from qa')
+
+    def _back_off(self, exc, tries, deadline):
+        # waits before the next try of a stage, and returns False if the stage should give up instead
+        wait = self._retry_wait(exc, tries, deadline)
+        if wait is None:
+            return False
+        time.sleep(wait)
+        return True
+
+    async def _back_off_async(self, exc, tries, deadline):
+        wait = self._retry_wait(exc, tries, deadline)
+        if wait is None:
+            return False
+        await asyncio.sleep(wait)
+        return True
+
+    def _retry_wait(self, exc, tries, deadline):
+        # there's no point in trying again while the upstream is down, or once the stage is out of time
+        if tries >= self.max_tries or isinstance(exc, (upstream.CircuitOpenError, upstream.DeadlineExceededError)):
+            return None
+        return upstream.backoff(tries, deadline)
+
+    def _run(self, name, priority, retry=False, deadline=None, on_partial=None, make_parser=None, **kwargs):
+        # guidance's synchronous calls can't be stopped part way, which deadlines, hedging and the stream
+        # parsers all need, so make them on an event loop of our own
+        return self._run_in_loop(self._run_async(name, priority, retry, deadline, on_partial, make_parser, **kwargs))
+
+    @staticmethod
+    def _run_in_loop(coroutine):
+        # like guidance itself, allow this to be called from code that is running on another event loop
+        try:
+            nest_asyncio.apply(asyncio.get_event_loop())
+        except RuntimeError:
+            pass
+        loop = new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            # clean up anything that was left running, such as when we were interrupted
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                loop.run_until_complete(asyncio.wait(tasks))
+            loop.close()
+
+    async def _run_async(self, name, priority, retry=False, deadline=None, on_partial=None, make_parser=None,
+                         **kwargs):
+        model = self.router.choose(name)
+        # once a call has taken longer than most of the template's calls on the model do, send a duplicate of
+        # it, and use whichever of them answers validly first (only passing on the partial output of one of them)
+        delay = (self.router.latencies.percentile((name, model), self.hedge_percentile)
+                 if self.hedge_percentile else None)
+        leader = []
+        # whether any call has been let through by the scheduler, as time spent queued for the rate limits
+        # says nothing about the model
+        granted = []
+        # cap the output at what the template's outputs have needed so far, and raise the cap if it cuts one off
+        maximum = TEMPLATE_MAX_TOKENS[name]
+        token_limit = token_caps.cap(name, self.backend_name(model), maximum)
+
+        def make_call():
+            def forward(text):
+                if not leader:
+                    leader.append(forward)
+                if leader[0] is forward:
+                    on_partial(text)
+
+            return self._call_async(name, model, priority, retry, forward if on_partial else None,
+                                    make_parser() if make_parser else None, token_limit=token_limit,
+                                    granted=granted, **kwargs)
+
+        try:
+            while True:
+                try:
+                    return await asyncio.wait_for(upstream.hedged(name, delay, make_call),
+                                                  deadline.remaining() if deadline else None)
+                except TruncatedError as exc:
+                    print(f'{exc}, retrying with a larger cap')
+                    token_limit = token_caps.larger_cap(token_limit, maximum)
+                    leader.clear()
+                    granted.clear()
+        except asyncio.TimeoutError as exc:
+            if not granted:
+                raise upstream.DeadlineExceededError(f'{name} call was still queued for the rate limits at the '
+                                                     f'{deadline.stage} deadline of {deadline.seconds}s') from exc
+            # a call that runs out of time once it has been sent counts against the model too
+            self.router.breakers[model].failed()
+            raise upstream.DeadlineExceededError(f'{name} call ran past the {deadline.stage} deadline of '
+                                                 f'{deadline.seconds}s') from exc
+
+    async def _call_async(self, name, model, priority, retry=False, on_partial=None, parser=None, token_limit=None,
+                          granted=None, **kwargs):
+        template = self.template(name, model)
+        token_limit = token_limit or TEMPLATE_MAX_TOKENS[name]
+        kwargs['token_limit'] = token_limit
+        breaker = self.router.breakers[model]
+        trial = breaker.before_call()
+        try:
+            queue_seconds = await self.scheduler.acquire_async(priority, estimate_tokens(template, **kwargs))
+        except BaseException:
+            breaker.cancelled(trial)
+            raise
+        if granted is not None:
+            granted.append(True)
+        start = time.perf_counter()
+        # the program's execution task starts with a copy of the context, so the backend sees the list
+        reasons = []
+        reset = finish_reasons.set(reasons)
+        try:
+            program = template(async_mode=True, stream=bool(on_partial or parser), caching=False if retry else None,
+                               **kwargs)
+        finally:
+            finish_reasons.reset(reset)
+        # cancelling an awaited guidance program also cancels its display task, which leaves the
+        # program's execution hanging, so only cancel the execution task when we are cancelled
+        execute_task = program._tasks[-1]
+        try:
+            if on_partial or parser:
+                await self._follow(program, execute_task,
+                                   self._partial_handler(name, template, start, on_partial, parser))
+            else:
+                await asyncio.shield(execute_task)
+        except JSONStreamError as exc:
+            # the output can't be valid any more, so don't wait for the rest of it (but do let the
+            # execution wind down, or guidance's display updater is left waiting for it)
+            execute_task.cancel()
+            await asyncio.wait((execute_task,))
+            self._record_call(name, template, program, start, queue_seconds, kwargs, exc)
+            self._record_early_abort(name, template, program, exc)
+            # bad output still means that the upstream is answering
+            breaker.succeeded(trial)
+            raise
+        except BaseException:
+            execute_task.cancel()
+            breaker.cancelled(trial)
+            raise
+        try:
+            await program
+        except Exception as exc:
+            self._record_call(name, template, program, start, queue_seconds, kwargs, exc)
+            breaker.failed(trial)
+            raise UpstreamError(exc) from exc
+        self._record_call(name, template, program, start, queue_seconds, kwargs)
+        breaker.succeeded(trial)
+        self.router.record(name, model, time.perf_counter() - start)
+        generated = completion_tokens(template, program)
+        # the backend says whether the output was cut off by its cap, and if it doesn't, output that stops part way
+        # through its JSON, or that has used up nearly all of its cap, was (a cap that is already the template's
+        # maximum can't be raised, though)
+        if reasons:
+            truncated = 'length' in reasons
+        else:
+            truncated = generated >= TRUNCATION_FRACTION * token_limit or (parser and not parser.done)
+        if token_limit < TEMPLATE_MAX_TOKENS[name] and truncated:
+            token_caps.record_truncation(name)
+            raise TruncatedError(f'{name} output was cut off at {token_limit} tokens')
+        token_caps.record(name, self.backend_name(model), generated, prompt_tokens(template, **kwargs))
+        if parser and not parser.done:
+            raise JSONStreamError('output ended before the JSON was complete', metrics.JSON_PARSE)
+        return program
+
+    @staticmethod
+    async def _follow(program, execute_task, handle_partial):
+        # passes the streamed program to handle_partial each time guidance updates it, until it is done (rather
+        # than iterating over the program, which can't be abandoned part way without hanging)
+        while not execute_task.done():
+            update = asyncio.ensure_future(program._emit_stream_event.wait())
+            try:
+                await asyncio.wait((update, execute_task), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                update.cancel()
+            program._emit_stream_event.clear()
+            handle_partial(program)
+
+    @staticmethod
+    def _partial_handler(name, template, start, on_partial, parser):
+        # passes the output generated so far to on_partial and the parser, and records how long the
+        # first of it took
+        first_content = []
+
+        def handle_partial(program):
+            text = generated_text(template, program)
+            if text:
+                if not first_content:
+                    first_content.append(time.perf_counter() - start)
+                    metrics.record_first_content(name, first_content[0])
+                if parser:
+                    parser.feed(text)
+                if on_partial:
+                    on_partial(text)
+
+        return handle_partial
+
+    @staticmethod
+    def _record_early_abort(name, template, program, exc):
+        generated = completion_tokens(template, program)
+        typical = metrics.typical_completion_tokens(name, TEMPLATE_MAX_TOKENS[name])
+        metrics.record_early_abort(name, exc.reason, generated, max(0, round(typical - generated)))
+
+    @staticmethod
+    def _record_call(name, template, program, start, queue_seconds, kwargs, error=None):
+        metrics.record_call(name, time.perf_counter() - start, queue_seconds, prompt_tokens(template, **kwargs),
+                            completion_tokens(template, program), str(error) if error else None)
+
+
+# one user's session, which keeps the grade, rubric, topic and question that the user has chosen, and
+# runs the stages on a core that can be shared with other sessions
+class Agent:
+    def __init__(self, api_key, priority=INTERACTIVE, llm=None, scheduler=None, fused=None, core=None):
+        self.core = core or AgentCore(api_key, llm, scheduler, fused)
+        self.priority = priority
+
+        self.grade = None
+        self.rubric = None
+        self.max_score = None
+        self.topic = None
+        self.question = None
+        # the test essays being generated ahead of time for the question, by quality
+        self.test_essays = {}
+        self.test_essays_key = None
+        # the gradings of the session's recent essays, that their revisions are compared with
+        self.gradings = OrderedDict()
+
+    @property
+    def llm(self):
+        return self.core.llm
+
+    @property
+    def standard(self):
+        return self.core.standard
+
+    @property
+    def fused(self):
+        return self.core.fused
+
+    def generate_rubric(self, grade):
+        self.grade = grade
+        self.rubric = self.core.get_rubric(grade, self.priority)
+        self.max_score = len(self.rubric) * 3 if self.rubric else None
+        # the question has to be regenerated for the new grade's rubric
+        self.topic = None
+        self.question = None
+        self.cancel_test_data()
+        if self.rubric:
+            self.core.prefetch_questions(grade, self.rubric)
+
+    def create_rubric(self, grade):
+        return self.core.create_rubric(grade, self.priority)
+
+    def get_display_rubric(self):
+        if self.rubric:
+            table = '| Criteria | Score |\n| --- | --- |\n'
+            for section in self.rubric:
+                table += '| **' + section['section'] + '** |\n'
+                for criteria in section['criteria']:
+                    table += '| ' + criteria['description'] + ' | ' + str(criteria['score']) + ' |\n'
+            return table
+        else:
+            return None
+
+    def get_question(self, topic):
+        # a question that failed is tried again on the next rerun
+        if not self.topic or self.topic != topic or self.question is None:
+            self.cancel_test_data()
+            self.topic = topic
+            self.question = self.core.get_question(self.grade, self.rubric, topic, self.priority)
+        return self.question
+
+    def create_question(self, grade, rubric, topic, priority=None):
+        return self.core.create_question(grade, rubric, topic, self.priority if priority is None else priority)
+
+    def check_valid(self, essay):
+        return self.core.check_valid(self, essay)
+
+    async def check_valid_async(self, essay):
+        return await self.core.check_valid_async(self, essay)
+
+    def score(self, essay, previous_essay, on_partial=None):
+        return self.remember_grading(essay, self.core.score(self, essay, previous_essay, on_partial))
+
+    async def score_async(self, essay, previous_essay, on_partial=None):
+        return self.remember_grading(essay, await self.core.score_async(self, essay, previous_essay, on_partial))
+
+    def grade_fused(self, essay, previous_essay, on_partial=None):
+        validity, score = self.core.grade_fused(self, essay, previous_essay, on_partial)
+        return validity, self.remember_grading(essay, score)
+
+    async def grade_fused_async(self, essay, previous_essay, on_partial=None):
+        validity, score = await self.core.grade_fused_async(self, essay, previous_essay, on_partial)
+        return validity, self.remember_grading(essay, score)
+
+    async def grade_async(self, essay, previous_essay, on_partial=None):
+        validity, score = await self.core.grade_async(self, essay, previous_essay, on_partial)
+        return validity, self.remember_grading(essay, score)
+
+    def remember_grading(self, essay, score):
+        if score:
+            key = revision.essay_key(essay)
+            self.gradings[key] = revision.graded(score)
+            self.gradings.move_to_end(key)
+            while len(self.gradings) > MAX_CACHED_RESULTS:
+                self.gradings.popitem(last=False)
+        return score
+
+    def previous_grading(self, essay):
+        return self.gradings.get(revision.essay_key(essay)) if essay else None
+
+    def prefetch_test_data(self):
+        # starts generating the test essay of every quality for the question, so that asking for one doesn't
+        # have to wait for it, unless they are already being generated
+        key = (self.grade, self.topic, self.question)
+        if not essay_prefetch.ENABLED or key == self.test_essays_key:
+            return
+        self.cancel_test_data()
+        # they would hold up other sessions' interactive calls, so leave them until they are asked for
+        if not self.core.has_spare_capacity('test', len(QUALITIES), essay_prefetch.SPARE_CAPACITY):
+            return
+        # the essays are for this question even if the session has moved on by the time they are generated
+        session = SimpleNamespace(grade=self.grade, question=self.question)
+        self.test_essays_key = key
+        self.test_essays = {quality: essay_prefetch.prefetcher.submit(
+                                lambda on_partial, quality=quality: self.core.get_test_data_async(session, quality,
+                                                                                                 on_partial))
+                            for quality in QUALITIES}
+
+    def cancel_test_data(self):
+        for prefetch in self.test_essays.values():
+            if prefetch.cancel():
+                essay_prefetch.count('cancelled')
+        self.test_essays = {}
+        self.test_essays_key = None
+
+    def get_test_data(self, quality, on_partial=None):
+        prefetch = self.test_essays.get(quality)
+        if (prefetch and self.test_essays_key == (self.grade, self.topic, self.question) and
+                not prefetch.future.cancelled()):
+            if not prefetch.started and prefetch.cancel():
+                # it is still queued behind the prefetches of other sessions, so generate it now instead
+                essay_prefetch.count('queued')
+                return self.core.get_test_data(self, quality, on_partial, self.priority)
+            # wait for a prefetch that is already running rather than starting the essay over, showing its
+            # output so far, but for no longer than the stage would take
+            essay_prefetch.count('hit' if prefetch.future.done() else 'wait')
+            try:
+                data = prefetch.wait(upstream.STAGE_DEADLINES.get('test'), on_partial)
+            except TimeoutError:
+                prefetch.cancel()
+                print('error prefetching test data: ran past the test deadline')
+                return None
+            except Exception as exc:
+                print(f'error prefetching test data: {exc}')
+                data = None
+            if data:
+                return data
+        essay_prefetch.count('miss')
+        return self.core.get_test_data(self, quality, on_partial, self.priority)
+
     def get_max_score(self):
         return self.max_score
 
 
+def submission_key(essay, question, rubric, previous_essay):
+    key_str = json.dumps([essay, question, rubric, previous_essay])
+    return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+
+def partial_json_string(text, field):
+    # the value of a string field of JSON output that may still be arriving, as far as it has got
+    match = re.search(rf'"{field}"\s*:\s*"((?:[^"\\]|\\.)*)', text, re.DOTALL)
+    if not match:
+        return ''
+    value = match.group(1)
+    # drop any escape sequence that has only partly arrived
+    for end in range(len(value), max(len(value) - 6, 0) - 1, -1):
+        try:
+            return json.loads(f'"{value[:end]}"', strict=False)
+        except json.JSONDecodeError:
+            pass
+    return ''
+
+
+def partial_grading(text):
+    table = partial_json_string(text, 'table')
+    summary = partial_json_string(text, 'summary')
+    markdown = f'#### Grading your essay...\n\n{table}'
+    if summary:
+        markdown += f'\n\n##### Summary\n{summary}'
+    return markdown
+
+
+async def get_results(agent, essay, previous_essay, on_partial=None):
+    # Streamlit reruns the whole script on every widget interaction, so only run the grading
+    # pipeline once per distinct submission and answer the reruns from the session's cache
+    import streamlit as st
+    results = st.session_state.setdefault('results', OrderedDict())
+    key = submission_key(essay, agent.question, agent.rubric, previous_essay)
+    if key in results:
+        results.move_to_end(key)
+        return results[key]
+
+    validity, score = await agent.grade_async(essay, previous_essay, on_partial)
+
+    # failed calls aren't cached, so the next rerun tries again
+    if validity and (score or not validity['valid']):
+        results[key] = (validity, score)
+        while len(results) > MAX_CACHED_RESULTS:
+            results.popitem(last=False)
+    return validity, score
+
+
+def create_core(api_key):
+    return AgentCore(api_key)
+
+
+def get_core(api_key):
+    # one core for the whole process, shared by every Streamlit session, which is kept in Streamlit's resource
+    # cache because the script's globals start afresh on every rerun
+    import streamlit as st
+    return st.cache_resource(create_core)(api_key)
+
+
 async def main():
-    canned_tests = {"Low": test_data.baseball_poor, "Medium": test_data.baseball_fair, "High": test_data.baseball_excellent}
+    # streamlit is only imported here, so that the grader can be imported without it, and running under
+    # Streamlit has already loaded it
+    import streamlit as st
     try:
+        if os.environ.get('METRICS_PORT'):
+            metrics.serve(int(os.environ['METRICS_PORT']))
         if 'agent' not in st.session_state:
             api_key = st.secrets['API_KEY']
-            st.session_state.agent = Agent(api_key)
+            st.session_state.agent = Agent(api_key, core=get_core(api_key))
         agent: Agent = st.session_state.agent
 
         st.set_page_config(page_title="AI for Education")
 
         # generate the rubric for the given grade
-        grade = (st.selectbox('Select your grade level:',
-                              ('First','Second','Third','Fourth','Fifth','Sixth','Seventh','Eighth',
-                               'Ninth','Tenth','Eleventh','Twelfth'), index=3))
-        if 'grade' not in st.session_state or grade != st.session_state['grade']:
+        grade = st.selectbox('Select your grade level:', GRADES, index=3)
+        if 'grade' not in st.session_state or grade != st.session_state['grade'] or not agent.rubric:
             # print(f'generating rubric for the {grade} grade')
             st.session_state['grade'] = grade
             agent.generate_rubric(grade)
@@ -518,7 +1363,7 @@ Your responses will be graded according to this rubric:
 
             if 'previous_essay' not in st.session_state:
                 st.session_state['previous_essay'] = ''
-            previous_essay = st.session_state['previous_essay']
+                st.session_state['graded_essay'] = ''
 
             st.write("\n\n")
             topic = st.text_input('Enter a topic for your essay')
@@ -528,21 +1373,25 @@ Your responses will be graded according to this rubric:
                 # print(f'\nquestion = {question}')
                 # print(f'\ntopic in question = ', topic in question)
 
+                if question is None:
+                    st.markdown('##### Error generating a question, please try again a bit later')
                 # simple test for inappropriate or otherwise problematic topics
-                if topic not in question:
+                elif topic not in question:
                     st.markdown("##### I'm sorry but I can't produce a prompt for that topic. Please choose a different topic.")
                 else:
                     st.markdown(question)
+                    # have the test essays ready by the time they are asked for
+                    agent.prefetch_test_data()
 
                     # three options: auto-generate essay, use canned test essay, or enter your own
                     with st.form('auto_form'):
                         auto_test = st.form_submit_button('Generate Test Essay')
-                        auto_quality = st.radio('Quality of test essay:', ('Low', 'Medium', 'High'),
+                        auto_quality = st.radio('Quality of test essay:', QUALITIES,
                                                 key='auto_qual', horizontal=True)
 
                     with st.form('canned_form'):
                         canned_test = st.form_submit_button('Use Canned Test Essay')
-                        canned_quality = st.radio('Quality of test essay:', ('Low', 'Medium', 'High'),
+                        canned_quality = st.radio('Quality of test essay:', QUALITIES,
                                                   key='canned_qual', horizontal=True)
 
                     with st.form('entered_form'):
@@ -550,11 +1399,20 @@ Your responses will be graded according to this rubric:
                         submit = st.form_submit_button('Submit')
 
                     if auto_test:
-                        st.session_state.essay = agent.get_test_data(auto_quality)
                         st.markdown(f'##### Generated {auto_quality} quality essay:')
-                        st.write(st.session_state.essay)
+                        # show the essay as it is written, then the finished one
+                        essay_placeholder = st.empty()
+                        st.session_state.essay = agent.get_test_data(auto_quality, essay_placeholder.write) or ''
+                        if st.session_state.essay:
+                            essay_placeholder.write(st.session_state.essay)
+                        else:
+                            essay_placeholder.markdown('##### Error generating the essay, please try again a bit later')
 
                     elif canned_test:
+                        # the canned essays are only loaded once one is asked for
+                        import test_data
+                        canned_tests = {"Low": test_data.baseball_poor, "Medium": test_data.baseball_fair,
+                                        "High": test_data.baseball_excellent}
                         st.session_state.essay = canned_tests[canned_quality]
                         st.markdown(f'##### Canned {canned_quality} quality essay:')
                         st.write(st.session_state.essay)
@@ -566,12 +1424,25 @@ Your responses will be graded according to this rubric:
                         essay = st.session_state.essay
                         # print(f'\nessay = {essay}')
 
-                        # first check if the essay is a valid response to the prompt
-                        validity = agent.check_valid(essay)
+                        # the previous essay has to stay the same across reruns of the same submission
+                        if essay == st.session_state['graded_essay']:
+                            previous_essay = st.session_state['previous_essay']
+                        else:
+                            previous_essay = st.session_state['graded_essay']
+
+                        # first check if the essay is a valid response to the prompt, then score it
+                        # show the grading as it is generated, until the checked result replaces it
+                        grading_placeholder = st.empty()
+                        validity, score = await get_results(
+                            agent, essay, previous_essay,
+                            lambda text: grading_placeholder.markdown(partial_grading(text)))
+                        grading_placeholder.empty()
                         # print(f'\nvalidity = {validity}')
 
-                        if validity['valid']:
-                            score = agent.score(essay, previous_essay)
+                        # a stage that ran out of time or found the upstream down gives no result
+                        if not validity or (validity['valid'] and not score):
+                            st.markdown('##### Error grading the essay, please try again a bit later')
+                        elif validity['valid']:
                             st.markdown(f"#### Your grade: {score['total']} / {agent.get_max_score()}")
                             st.markdown(score['table'])
                             st.write("\n\n")
@@ -580,7 +1451,8 @@ Your responses will be graded according to this rubric:
                             if score['comparison']:
                                 st.markdown(f'##### Comparison with previous essay')
                                 st.markdown(score['comparison'])
-                            st.session_state['previous_essay'] = essay
+                            st.session_state['previous_essay'] = previous_essay
+                            st.session_state['graded_essay'] = essay
                             # print(f'\nscore = {score}')
                         else:
                             st.markdown(f'##### Feedback')
@@ -592,6 +1464,7 @@ Your responses will be graded according to this rubric:
         st.write('Error occurred, please try again later\n\n')
         st.write(traceback.format_exc())
 
-loop = new_event_loop()
-set_event_loop(loop)
-run(main())
+if __name__ == '__main__':
+    loop = new_event_loop()
+    set_event_loop(loop)
+    run(main())
@@ -0,0 +1,223 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# failure reasons of a stage's tries
+JSON_PARSE = 'json_parse'
+SANITY_CHECK = 'sanity_check'
+QA_REJECTED = 'qa_rejected'
+UPSTREAM = 'upstream'
+DEADLINE = 'deadline'
+CIRCUIT_OPEN = 'circuit_open'
+
+SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+TRIES_BUCKETS = (1, 2, 3, 4, 5)
+
+
+def _label_str(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{_label_str(labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+        counts = [bucket_count + (value <= bound) for bucket_count, bound in zip(counts, self.buckets)]
+        self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_label_str(labels + (("le", bound),))} {bucket_count}')
+            lines.append(f'{self.name}_bucket{_label_str(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{self.name}_sum{_label_str(labels)} {total}')
+            lines.append(f'{self.name}_count{_label_str(labels)} {count}')
+        return lines
+
+
+# a value that is read from collect() when the metrics are rendered, which returns it for each set of labels
+class Gauge:
+    def __init__(self, name, help_text, collect):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge']
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f'{self.name}{_label_str(labels)} {value}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+        self.trace_file = None
+
+    def counter(self, name, help_text):
+        metric = Counter(name, help_text)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets=SECONDS_BUCKETS):
+        metric = Histogram(name, help_text, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, collect):
+        metric = Gauge(name, help_text, collect)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+    def trace(self, event):
+        if self.trace_file:
+            with self.lock:
+                with open(self.trace_file, 'a') as file:
+                    file.write(json.dumps({'time': time.time(), **event}) + '\n')
+
+
+registry = Registry()
+registry.trace_file = os.environ.get('METRICS_TRACE_FILE')
+
+llm_calls = registry.counter('grader_llm_calls_total', 'LLM template calls, by template and outcome')
+llm_call_seconds = registry.histogram('grader_llm_call_seconds', 'Wall time of LLM template calls')
+llm_queue_seconds = registry.histogram('grader_llm_queue_seconds', 'Time LLM calls waited in the scheduler')
+llm_first_content_seconds = registry.histogram('grader_llm_first_content_seconds',
+                                               'Time until streamed LLM calls produced their first output')
+llm_prompt_tokens = registry.counter('grader_llm_prompt_tokens_total', 'Estimated prompt tokens sent')
+llm_completion_tokens = registry.counter('grader_llm_completion_tokens_total', 'Estimated completion tokens received')
+early_aborts = registry.counter('grader_llm_early_aborts_total',
+                                'LLM calls abandoned as soon as their output could no longer be valid, by reason')
+early_abort_saved_tokens = registry.counter('grader_llm_early_abort_saved_tokens_total',
+                                            'Estimated completion tokens not generated because of early aborts')
+stage_runs = registry.counter('grader_stage_runs_total', 'Agent stage runs, by stage and outcome')
+stage_seconds = registry.histogram('grader_stage_seconds', 'Wall time of Agent stages, including retries')
+stage_tries = registry.histogram('grader_stage_tries', 'Tries used by Agent stages', TRIES_BUCKETS)
+stage_failures = registry.counter('grader_stage_failures_total', 'Failed tries of Agent stages, by reason')
+
+
+# total completion tokens and number of the successful calls of each template
+_completion_sizes = {}
+
+
+def typical_completion_tokens(template, default):
+    with registry.lock:
+        tokens, calls = _completion_sizes.get(template, (0, 0))
+    return tokens / calls if calls else default
+
+
+def record_call(template, seconds, queue_seconds, prompt_tokens, completion_tokens, error=None):
+    outcome = 'error' if error else 'ok'
+    with registry.lock:
+        if not error:
+            tokens, calls = _completion_sizes.get(template, (0, 0))
+            _completion_sizes[template] = (tokens + completion_tokens, calls + 1)
+        llm_calls.inc(template=template, outcome=outcome)
+        llm_call_seconds.observe(seconds, template=template)
+        llm_queue_seconds.observe(queue_seconds, template=template)
+        llm_prompt_tokens.inc(prompt_tokens, template=template)
+        llm_completion_tokens.inc(completion_tokens, template=template)
+    registry.trace({'event': 'llm_call', 'template': template, 'seconds': seconds, 'queue_seconds': queue_seconds,
+                    'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'error': error})
+
+
+def record_first_content(template, seconds):
+    with registry.lock:
+        llm_first_content_seconds.observe(seconds, template=template)
+    registry.trace({'event': 'first_content', 'template': template, 'seconds': seconds})
+
+
+def record_early_abort(template, reason, completion_tokens, saved_tokens):
+    with registry.lock:
+        early_aborts.inc(template=template, reason=reason)
+        early_abort_saved_tokens.inc(saved_tokens, template=template)
+    registry.trace({'event': 'early_abort', 'template': template, 'reason': reason,
+                    'completion_tokens': completion_tokens, 'saved_tokens': saved_tokens})
+
+
+def record_stage(stage, seconds, failures, ok):
+    outcome = 'ok' if ok else 'failed'
+    tries = len(failures) + (1 if ok else 0)
+    with registry.lock:
+        stage_runs.inc(stage=stage, outcome=outcome)
+        stage_seconds.observe(seconds, stage=stage)
+        stage_tries.observe(tries, stage=stage)
+        for reason in failures:
+            stage_failures.inc(stage=stage, reason=reason)
+    registry.trace({'event': 'stage', 'stage': stage, 'seconds': seconds, 'tries': tries, 'failures': failures,
+                    'outcome': outcome})
+
+
+# times one run of an Agent stage and collects the reasons its tries failed
+class StageTrace:
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = time.perf_counter()
+        self.failures = []
+
+    def failed(self, reason):
+        self.failures.append(reason)
+
+    def done(self, ok):
+        record_stage(self.stage, time.perf_counter() - self.start, self.failures, bool(ok))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+def serve(port):
+    # serves /metrics for Prometheus to scrape, from a background thread (only once per process)
+    global _server
+    with registry.lock:
+        if _server is None:
+            _server = ThreadingHTTPServer(('', port), MetricsHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
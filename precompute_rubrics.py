@@ -0,0 +1,33 @@
+import argparse
+from main import Agent, GRADES, rubric_prompt
+from rubric_store import rubric_store
+from scheduler import BATCH
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate and store the rubrics for all grades ahead of time.')
+    parser.add_argument('--api-key', default=None, help='OpenAI API key (defaults to $OPENAI_API_KEY)')
+    parser.add_argument('--grade', action='append', choices=GRADES,
+                        help='grade to generate, may be repeated (defaults to all grades)')
+    parser.add_argument('--force', action='store_true', help='regenerate rubrics that are already stored')
+    args = parser.parse_args()
+
+    agent = Agent(args.api_key, priority=BATCH)
+    model_name = agent.core.model_name('rubric')
+    failed = 0
+    for grade in args.grade or GRADES:
+        if not args.force and rubric_store.get(agent.standard, grade, rubric_prompt, model_name) is not None:
+            print(f'{grade}: already stored')
+            continue
+        rubric = agent.create_rubric(grade)
+        if rubric is None:
+            print(f'{grade}: failed to generate rubric')
+            failed += 1
+            continue
+        rubric_store.put(agent.standard, grade, rubric_prompt, model_name, rubric)
+        print(f'{grade}: stored {rubric_store.path(agent.standard, grade, rubric_prompt, model_name)}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    exit(main())
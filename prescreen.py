@@ -0,0 +1,108 @@
+import os
+import re
+import metrics
+
+# essays outside these limits are rejected without asking the LLM, a limit of 0 turns its check off
+MIN_WORDS = int(os.environ.get('PRESCREEN_MIN_WORDS', 15))
+MAX_WORDS = int(os.environ.get('PRESCREEN_MAX_WORDS', 2000))
+# fraction of the essay's content words that have to appear in the question's Context
+MIN_CONTEXT_OVERLAP = float(os.environ.get('PRESCREEN_MIN_CONTEXT_OVERLAP', 0.02))
+MAX_TOPIC_LENGTH = 100
+
+# words that make a topic unsuitable for an elementary school essay, on top of any in the file
+# that TOPIC_BLOCKLIST names (one per line)
+BLOCKED_TOPIC_WORDS = {'alcohol', 'beer', 'bomb', 'bombs', 'cocaine', 'drugs', 'drunk', 'gambling', 'gore', 'heroin',
+                       'marijuana', 'meth', 'murder', 'nude', 'nudity', 'porn', 'pornography', 'sex', 'sexual',
+                       'suicide', 'terrorism', 'terrorist', 'torture', 'vodka', 'whiskey'}
+
+# words too common to show that an essay is about its context
+STOP_WORDS = {'about', 'also', 'because', 'been', 'being', 'could', 'does', 'doing', 'from', 'have', 'into', 'just',
+              'like', 'made', 'make', 'many', 'more', 'most', 'much', 'only', 'other', 'over', 'should', 'some',
+              'such', 'than', 'that', 'their', 'them', 'then', 'there', 'these', 'they', 'this', 'those', 'very',
+              'were', 'what', 'when', 'where', 'which', 'while', 'will', 'with', 'would', 'your'}
+
+# LLM calls that grading an essay takes, on the multi-call and fused paths, that only checking its validity
+# takes, and that generating a question takes
+ESSAY_CALLS = 2
+FUSED_ESSAY_CALLS = 1
+VALIDITY_CALLS = 1
+TOPIC_CALLS = 1
+
+prescreen_rejections = metrics.registry.counter('grader_prescreen_rejections_total',
+                                                'Essays and topics rejected without an LLM call, by reason')
+prescreen_saved_calls = metrics.registry.counter('grader_prescreen_saved_calls_total',
+                                                 'LLM calls not made because of pre-screen rejections')
+
+
+def _load_blocklist():
+    path = os.environ.get('TOPIC_BLOCKLIST')
+    if not path:
+        return BLOCKED_TOPIC_WORDS
+    with open(path, 'r') as file:
+        return BLOCKED_TOPIC_WORDS | {line.strip().lower() for line in file if line.strip()}
+
+
+blocked_topic_words = _load_blocklist()
+
+
+def content_words(text):
+    return {word for word in re.findall(r"[a-z][a-z']+", text.lower()) if len(word) >= 4 and word not in STOP_WORDS}
+
+
+def question_context(question):
+    # the Context section of a generated question, or all of it if it has no such section
+    match = re.search(r'#+\s*Context\s*\n(.*?)(?=\n#+\s*\w|\Z)', question, re.DOTALL)
+    return match.group(1) if match else question
+
+
+def context_overlap(essay, question):
+    words = content_words(essay)
+    if not words:
+        return 0.0
+    return len(words & content_words(question_context(question))) / len(words)
+
+
+def check_essay(essay, question):
+    # returns the (reason, feedback) that an obviously invalid essay is rejected with, or None if it
+    # has to be checked by the LLM
+    words = len(essay.split())
+    if MIN_WORDS and words < MIN_WORDS:
+        return 'too_short', (f'Your essay is only {words} words long, which is too short to respond to the prompt. '
+                             'Write several sentences that answer the question, using facts from the context.')
+    if MAX_WORDS and words > MAX_WORDS:
+        return 'too_long', (f'Your essay is {words} words long, which is more than the {MAX_WORDS} words that can be '
+                            'graded. Shorten it so that it only answers the question.')
+    if question and MIN_CONTEXT_OVERLAP and context_overlap(essay, question) < MIN_CONTEXT_OVERLAP:
+        return 'off_topic', ('Your essay doesn\'t use any of the information in the context of the prompt. Read the '
+                             'context again, and use its facts to answer the question.')
+    return None
+
+
+def check_topic(topic):
+    # returns the reason that a topic is rejected without generating a question for it, or None
+    if len(topic) > MAX_TOPIC_LENGTH:
+        return 'too_long'
+    if not re.search(r'[a-zA-Z]', topic):
+        return 'no_words'
+    if set(re.findall(r'[a-z]+', topic.lower())) & blocked_topic_words:
+        return 'blocked'
+    return None
+
+
+def record_rejection(kind, reason, saved_calls):
+    with metrics.registry.lock:
+        prescreen_rejections.inc(kind=kind, reason=reason)
+        prescreen_saved_calls.inc(saved_calls, kind=kind)
+    metrics.registry.trace({'event': 'prescreen', 'kind': kind, 'reason': reason, 'saved_calls': saved_calls})
+
+
+def stats():
+    # the rejections of each kind by reason, and the LLM calls that they saved
+    with metrics.registry.lock:
+        report = {}
+        for labels, count in prescreen_rejections.values.items():
+            labels = dict(labels)
+            report.setdefault(labels['kind'], {'rejected': {}, 'saved_calls': 0})['rejected'][labels['reason']] = count
+        for labels, count in prescreen_saved_calls.values.items():
+            report.setdefault(dict(labels)['kind'], {'rejected': {}, 'saved_calls': 0})['saved_calls'] += count
+    return report
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+DEFAULT_MAX_ENTRIES = int(os.environ.get('QUESTION_CACHE_SIZE', 500))
+# popular questions older than this are regenerated in the background, while the old one is still served
+DEFAULT_REFRESH_SECONDS = float(os.environ.get('QUESTION_REFRESH_SECONDS', 60 * 60))
+# topics to have questions ready for as soon as a grade's rubric is known, on top of the popular ones
+PREFETCH_TOPICS = [topic.strip() for topic in os.environ.get('QUESTION_PREFETCH_TOPICS', '').split(',')
+                   if topic.strip()]
+# how many requests make a topic popular, and how many of the popular topics to prefetch for each grade
+POPULAR_REQUESTS = 3
+PREFETCH_COUNT = 10
+
+question_lookups = metrics.registry.counter('grader_question_cache_total',
+                                            'Question cache lookups and background generations, by result')
+
+
+def _count(result):
+    with metrics.registry.lock:
+        question_lookups.inc(result=result)
+
+
+def rubric_version(rubric):
+    return hashlib.sha256(json.dumps(rubric, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+# process-wide LRU cache of generated questions, keyed by (grade, topic, rubric version, model), which
+# also generates the questions for popular topics ahead of time and refreshes them in the background
+class QuestionCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, refresh_seconds=DEFAULT_REFRESH_SECONDS,
+                 prefetch_topics=PREFETCH_TOPICS):
+        self.max_entries = max_entries
+        self.refresh_seconds = refresh_seconds
+        self.prefetch_topics = prefetch_topics
+        self._questions = OrderedDict()
+        self._requests = Counter()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='question-prefetch')
+
+    @staticmethod
+    def key(grade, topic, rubric, model):
+        return grade, topic, rubric_version(rubric), model
+
+    def get(self, grade, topic, rubric, model):
+        key = self.key(grade, topic, rubric, model)
+        with self._lock:
+            entry = self._questions.get(key)
+            if entry:
+                self._questions.move_to_end(key)
+            return entry['question'] if entry else None
+
+    def put(self, grade, topic, rubric, model, question):
+        with self._lock:
+            self._questions[self.key(grade, topic, rubric, model)] = {'question': question, 'created': time.time()}
+            self._questions.move_to_end(self.key(grade, topic, rubric, model))
+            while len(self._questions) > self.max_entries:
+                evicted, _ = self._questions.popitem(last=False)
+                self._key_locks.pop(evicted, None)
+
+    def get_or_create(self, grade, topic, rubric, model, create):
+        # create(topic) generates the question, and is also used to refresh it later in the background
+        key = self.key(grade, topic, rubric, model)
+        with self._lock:
+            self._requests[topic] += 1
+            popular = self._requests[topic] >= POPULAR_REQUESTS
+            entry = self._questions.get(key)
+            if entry:
+                self._questions.move_to_end(key)
+                stale = time.time() - entry['created'] > self.refresh_seconds
+            if len(self._requests) > self.max_entries * 10:
+                self._requests = Counter(dict(self._requests.most_common(self.max_entries)))
+        if entry:
+            _count('hit')
+            if stale and popular:
+                self._submit(key, 'refresh', lambda: self._create(grade, topic, rubric, model, create, refresh=True))
+            return entry['question']
+
+        _count('miss')
+        return self._create(grade, topic, rubric, model, create)
+
+    def prefetch(self, grade, rubric, model, create):
+        # generates the questions that the grade is likely to be asked for, without waiting for them
+        with self._lock:
+            popular = [topic for topic, count in self._requests.most_common(PREFETCH_COUNT)
+                       if count >= POPULAR_REQUESTS]
+        for topic in dict.fromkeys(self.prefetch_topics + popular):
+            if self.get(grade, topic, rubric, model) is None:
+                self._submit(self.key(grade, topic, rubric, model), 'prefetch',
+                             lambda topic=topic: self._create(grade, topic, rubric, model, create))
+
+    def _create(self, grade, topic, rubric, model, create, refresh=False):
+        # only let one caller generate a given question, the others wait for its result
+        key = self.key(grade, topic, rubric, model)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            question = None if refresh else self.get(grade, topic, rubric, model)
+            if question is None:
+                question = create(topic)
+                if question is not None:
+                    self.put(grade, topic, rubric, model, question)
+        return question
+
+    def _submit(self, key, kind, func):
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+
+        def run():
+            try:
+                if func() is not None:
+                    _count(kind)
+            except Exception as exc:
+                print(f'error in question {kind}: {exc}')
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+        self._executor.submit(run)
+
+
+question_cache = QuestionCache()
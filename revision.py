@@ -0,0 +1,78 @@
+import difflib
+import hashlib
+import json
+import re
+from score_validator import match_sections, parse_table
+
+# previous essays this short aren't compared with, as the grading templates ask
+MIN_PREVIOUS_WORDS = 10
+# the most words of each sentence that the revision added that are quoted, as the whole essay is in the prompt too
+MAX_QUOTED_WORDS = 8
+# once more than this fraction of the previous essay has changed, the revision is a rewrite, and its previous
+# grading says more about it than the diff does
+MAX_CHANGED_FRACTION = 0.5
+
+
+def essay_key(essay):
+    return hashlib.sha256(essay.strip().encode('utf-8')).hexdigest()[:16]
+
+
+def sentences(text):
+    return [' '.join(sentence.split()) for sentence in re.split(r'(?<=[.!?])\s+', text.strip()) if sentence.strip()]
+
+
+def _quote(sentence):
+    words = sentence.split()
+    return sentence if len(words) <= MAX_QUOTED_WORDS else ' '.join(words[:MAX_QUOTED_WORDS]) + ' ...'
+
+
+def graded(score):
+    # what is kept of an essay's grading to compare its revision with
+    return {'scores': dict(parse_table(score['table'])), 'total': score['total'], 'summary': score['summary']}
+
+
+def essay_diff(previous_essay, essay, rewrite_summary=False):
+    # the sentences of the previous essay that the revision removed or rewrote, and the start of those it added,
+    # or with rewrite_summary, only how much of it was kept if most of it was changed
+    old, new = sentences(previous_essay), sentences(essay)
+    opcodes = difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes()
+    kept = sum(old_end - old_start for tag, old_start, old_end, _, _ in opcodes if tag == 'equal')
+    lines = [f'{kept} of the {len(old)} sentences of the previous essay are unchanged.']
+    if rewrite_summary and old and kept < (1 - MAX_CHANGED_FRACTION) * len(old):
+        return lines[0] + f' The essay was rewritten, with {len(new) - kept} new sentences.'
+    for tag, old_start, old_end, new_start, new_end in opcodes:
+        if tag != 'equal':
+            lines += [f'- {sentence}' for sentence in old[old_start:old_end]]
+            lines += [f'+ {_quote(sentence)}' for sentence in new[new_start:new_end]]
+    return '\n'.join(lines)
+
+
+def revision_context(previous_essay, essay, previous=None):
+    # what the grading templates are told about the previous essay: how it was graded, if that is known, and
+    # which of its sentences were changed, instead of the whole of it
+    if len(previous_essay.split()) <= MIN_PREVIOUS_WORDS:
+        return ''
+    context = ''
+    if previous:
+        context = f'Previous grading: {json.dumps(previous, ensure_ascii=False)}\n'
+    return context + f'Changes (- removed, + added):\n{essay_diff(previous_essay, essay, bool(previous))}'
+
+
+def compare(score, previous):
+    # puts the section-by-section comparison with the previous grading in front of the template's comparison
+    if not previous:
+        return score
+    table = parse_table(score['table'])
+    names = list(previous['scores'])
+    matches = match_sections(names, [criteria for criteria, section_score in table])
+    rows = [f'| {criteria} | {previous["scores"][names[match]]} | {section_score} |'
+            for (criteria, section_score), match in zip(table, matches) if match is not None]
+    if not rows:
+        return score
+    change = ('went up' if score['total'] > previous['total'] else
+              'went down' if score['total'] < previous['total'] else 'stayed the same')
+    comparison = (f'Your total score {change}, from {previous["total"]} to {score["total"]}.\n\n'
+                  '| Criteria | Previous Score | Score |\n| --- | --- | --- |\n' + '\n'.join(rows))
+    if score['comparison']:
+        comparison += f'\n\n{score["comparison"]}'
+    return {**score, 'comparison': comparison}
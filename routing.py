@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+import metrics
+from upstream import CircuitBreaker, LatencyTracker
+
+DEFAULT_MODEL = os.environ.get('DEFAULT_MODEL', 'gpt-4')
+TEMPLATES = ('rubric', 'question', 'validity', 'grading', 'grading_qa', 'fused_grading', 'test')
+
+# a model is too slow for a template once this percentile of its recent calls of the template took longer
+# than the route's max_latency, going by at least ROUTE_MIN_SAMPLES calls
+ROUTE_LATENCY_PERCENTILE = 90
+ROUTE_MIN_SAMPLES = 5
+# one in this many of the calls that are routed away from a slow model still go to it, to find out
+# whether it has sped up again
+PROBE_INTERVAL = 10
+
+routed_calls = metrics.registry.counter('grader_llm_routed_calls_total', 'LLM calls by template and the model used')
+route_fallbacks = metrics.registry.counter('grader_llm_route_fallbacks_total',
+                                           'LLM calls routed past a model, by template, model and reason')
+
+
+def parse_routes(config):
+    # takes {template: model, [models] or {"models": [models], "max_latency": seconds}}, where the first
+    # model is used unless it is down or slower than max_latency, then the next one, and so on, and
+    # templates that aren't given use DEFAULT_MODEL
+    unknown = set(config) - set(TEMPLATES)
+    if unknown:
+        raise Exception(f'unknown templates in model routes: {", ".join(sorted(unknown))}')
+    routes = {}
+    for template in TEMPLATES:
+        route = config.get(template, [DEFAULT_MODEL])
+        if isinstance(route, str):
+            route = [route]
+        if isinstance(route, list):
+            route = {'models': route}
+        if not route.get('models'):
+            raise Exception(f'no models in the route for {template}')
+        routes[template] = {'models': list(route['models']), 'max_latency': route.get('max_latency')}
+    return routes
+
+
+def routes_from_env():
+    # e.g. MODEL_ROUTES='{"validity": {"models": ["gpt-3.5-turbo", "gpt-4"], "max_latency": 10},
+    #                     "test": "gpt-3.5-turbo"}'
+    return parse_routes(json.loads(os.environ.get('MODEL_ROUTES', '{}')))
+
+
+# picks the model for each call of a template from its route, falling back to the route's next model
+# while a model's circuit is open or its calls of the template have been slow
+class Router:
+    def __init__(self, routes):
+        self.routes = routes
+        self.models = list(dict.fromkeys(model for route in routes.values() for model in route['models']))
+        self.breakers = {model: CircuitBreaker() for model in self.models}
+        self.latencies = LatencyTracker()
+        self._skipped = {}
+        self._lock = threading.Lock()
+
+    def primary(self, template):
+        return self.routes[template]['models'][0]
+
+    def choose(self, template):
+        route = self.routes[template]
+        for model in route['models'][:-1]:
+            if not self.breakers[model].available():
+                self._fallback(template, model, 'circuit_open')
+            elif self._too_slow(template, model, route['max_latency']):
+                self._fallback(template, model, 'slow')
+            else:
+                return self._routed(template, model)
+        return self._routed(template, route['models'][-1])
+
+    def record(self, template, model, seconds):
+        self.latencies.record((template, model), seconds)
+
+    def _too_slow(self, template, model, max_latency):
+        if max_latency is None:
+            return False
+        latency = self.latencies.percentile((template, model), ROUTE_LATENCY_PERCENTILE, ROUTE_MIN_SAMPLES)
+        if latency is None or latency <= max_latency:
+            return False
+        with self._lock:
+            skipped = self._skipped.get((template, model), 0) + 1
+            self._skipped[(template, model)] = skipped % PROBE_INTERVAL
+        return skipped % PROBE_INTERVAL != 0
+
+    @staticmethod
+    def _routed(template, model):
+        with metrics.registry.lock:
+            routed_calls.inc(template=template, model=model)
+        return model
+
+    @staticmethod
+    def _fallback(template, model, reason):
+        with metrics.registry.lock:
+            route_fallbacks.inc(template=template, model=model, reason=reason)
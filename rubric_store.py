@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import threading
+
+# bump this whenever the stored rubric format or its sanity checks change, so stale files are ignored
+RUBRIC_STORE_VERSION = 1
+
+# where the grader keeps what it learns across restarts, outside the source tree so that it isn't committed
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'xo-ai')
+DEFAULT_RUBRIC_DIR = os.environ.get('RUBRIC_STORE_DIR', os.path.join(CACHE_DIR, 'rubrics'))
+
+
+def check_rubric_section(section):
+    if len(section['criteria']) != 4:
+        raise Exception(f'section doesn\'t have four criteria: {section}')
+    score = 0
+    for criteria in section['criteria']:
+        if len(criteria['description']) == 0:
+            raise Exception(f'missing description in criteria: {criteria}')
+        score += criteria['score']
+    if score != 6:
+        raise Exception(f'incorrect scores in section: {section}')
+
+
+def check_rubric(rubric):
+    if not isinstance(rubric, list) or len(rubric) == 0:
+        raise Exception('rubric contains no sections')
+    for section in rubric:
+        check_rubric_section(section)
+
+
+def compact_rubric(rubric):
+    # the canonical form that rubrics are given to the templates in, which is the same text for the same
+    # rubric (so that prompts that include it share a prefix), without the whitespace of the generated JSON
+    # or the repeated "description" and "score" keys of its criteria
+    return json.dumps([{'section': section['section'],
+                        'criteria': {str(criteria['score']): criteria['description']
+                                     for criteria in sorted(section['criteria'], key=lambda c: c['score'])}}
+                       for section in rubric], separators=(',', ':'), ensure_ascii=False)
+
+
+# process-wide rubric cache, backed by one JSON file per (standard, grade, prompt, model) on disk
+class RubricStore:
+    def __init__(self, directory=DEFAULT_RUBRIC_DIR):
+        self.directory = directory
+        self._rubrics = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @staticmethod
+    def prompt_hash(prompt):
+        return hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+
+    def key(self, standard, grade, prompt, model):
+        key_str = json.dumps([RUBRIC_STORE_VERSION, standard, grade, model, self.prompt_hash(prompt)])
+        return hashlib.sha256(key_str.encode('utf-8')).hexdigest()[:16]
+
+    def path(self, standard, grade, prompt, model):
+        return os.path.join(self.directory, f'{grade.lower()}-{self.key(standard, grade, prompt, model)}.json')
+
+    def get(self, standard, grade, prompt, model):
+        key = self.key(standard, grade, prompt, model)
+        with self._lock:
+            rubric = self._rubrics.get(key)
+        if rubric is None:
+            rubric = self._load(standard, grade, prompt, model)
+            if rubric is not None:
+                with self._lock:
+                    self._rubrics[key] = rubric
+        return rubric
+
+    def put(self, standard, grade, prompt, model, rubric):
+        with self._lock:
+            self._rubrics[self.key(standard, grade, prompt, model)] = rubric
+        self._save(standard, grade, prompt, model, rubric)
+
+    def get_or_create(self, standard, grade, prompt, model, create):
+        rubric = self.get(standard, grade, prompt, model)
+        if rubric is not None:
+            return rubric
+
+        # only let one caller generate a given rubric, the others wait for its result
+        key = self.key(standard, grade, prompt, model)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            rubric = self.get(standard, grade, prompt, model)
+            if rubric is None:
+                rubric = create()
+                if rubric is not None:
+                    self.put(standard, grade, prompt, model, rubric)
+        return rubric
+
+    def _load(self, standard, grade, prompt, model):
+        try:
+            with open(self.path(standard, grade, prompt, model), 'r') as file:
+                entry = json.load(file)
+            if (entry['version'] != RUBRIC_STORE_VERSION or entry['standard'] != standard or entry['grade'] != grade
+                    or entry['model'] != model):
+                return None
+            check_rubric(entry['rubric'])
+            return entry['rubric']
+        except FileNotFoundError:
+            return None
+        except Exception as exc:
+            print(f'error loading stored rubric: {exc}')
+            return None
+
+    def _save(self, standard, grade, prompt, model, rubric):
+        entry = {
+            'version': RUBRIC_STORE_VERSION,
+            'standard': standard,
+            'grade': grade,
+            'model': model,
+            'prompt_hash': self.prompt_hash(prompt),
+            'rubric': rubric,
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.path(standard, grade, prompt, model)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as file:
+                json.dump(entry, file, indent=2)
+            os.replace(tmp_path, path)
+        except Exception as exc:
+            print(f'error saving rubric: {exc}')
+
+
+rubric_store = RubricStore()
@@ -0,0 +1,174 @@
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+import metrics
+
+# request priorities, lower values are served first
+INTERACTIVE = 0
+BACKGROUND = 1
+BATCH = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background', BATCH: 'batch'}
+
+# the share of the rate limits that only interactive requests can use, so that background and batch calls
+# can't leave a user waiting for the limits to refill
+INTERACTIVE_RESERVE = float(os.environ.get('SCHEDULER_INTERACTIVE_RESERVE', 0.25))
+
+# how often async waiters check whether they can go ahead
+POLL_INTERVAL = 0.05
+
+
+# a per_minute of None or 0 means no limit
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute or None
+        self.tokens = self.capacity
+        self.rate = per_minute / 60 if per_minute else None
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # reserve is the share of the capacity that has to be left in the bucket after taking the amount
+    def wait_time(self, amount, now, reserve=0):
+        if self.capacity is None:
+            return 0
+        self._refill(now)
+        needed = self._floor(reserve) + self._capped(amount, reserve)
+        return 0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def take(self, amount, reserve=0):
+        if self.capacity is None:
+            return
+        self.tokens -= self._capped(amount, reserve)
+
+    def _floor(self, reserve):
+        return reserve * self.capacity
+
+    def _capped(self, amount, reserve):
+        return min(amount, self.capacity - self._floor(reserve))
+
+
+class Ticket:
+    def __init__(self, priority, seq, tokens):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.queued = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+# process-wide gate in front of every LLM call, which keeps within the requests-per-minute and
+# tokens-per-minute limits of the API and lets higher priority requests jump the queue
+class Scheduler:
+    def __init__(self, requests_per_minute, tokens_per_minute, interactive_reserve=INTERACTIVE_RESERVE):
+        self.interactive_reserve = interactive_reserve
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._seq = itertools.count()
+
+        self._depth = {priority: 0 for priority in PRIORITY_NAMES}
+        self._max_depth = {priority: 0 for priority in PRIORITY_NAMES}
+        self._granted = {priority: 0 for priority in PRIORITY_NAMES}
+        self._wait_seconds = {priority: 0.0 for priority in PRIORITY_NAMES}
+
+    def acquire(self, priority, tokens):
+        with self._condition:
+            ticket = self._enqueue(priority, tokens)
+            try:
+                while True:
+                    wait = self._try_grant(ticket)
+                    if wait == 0:
+                        return time.monotonic() - ticket.queued
+                    self._condition.wait(wait)
+            except BaseException:
+                self._remove(ticket)
+                raise
+
+    async def acquire_async(self, priority, tokens):
+        with self._condition:
+            ticket = self._enqueue(priority, tokens)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._try_grant(ticket)
+                if wait == 0:
+                    return time.monotonic() - ticket.queued
+                await asyncio.sleep(min(wait or POLL_INTERVAL, POLL_INTERVAL))
+        except BaseException:
+            with self._condition:
+                self._remove(ticket)
+            raise
+
+    def has_spare(self, requests, tokens, headroom):
+        # whether the calls could be let through now, with none waiting, and still leave headroom (a share of
+        # each limit) in the buckets
+        with self._condition:
+            if self._waiting:
+                return False
+            now = time.monotonic()
+            return (self._requests.wait_time(requests, now, headroom) == 0 and
+                    self._tokens.wait_time(tokens, now, headroom) == 0)
+
+    def metrics(self):
+        with self._condition:
+            return {
+                PRIORITY_NAMES[priority]: {
+                    'queue_depth': self._depth[priority],
+                    'max_queue_depth': self._max_depth[priority],
+                    'granted': self._granted[priority],
+                    'wait_seconds': self._wait_seconds[priority],
+                } for priority in PRIORITY_NAMES
+            }
+
+    def _enqueue(self, priority, tokens):
+        ticket = Ticket(priority, next(self._seq), tokens)
+        heapq.heappush(self._waiting, ticket)
+        self._depth[priority] += 1
+        self._max_depth[priority] = max(self._max_depth[priority], self._depth[priority])
+        return ticket
+
+    def _remove(self, ticket):
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+            self._depth[ticket.priority] -= 1
+            self._condition.notify_all()
+
+    # returns 0 if the ticket was granted, otherwise how long to wait before trying again (None to wait
+    # until another ticket has been granted)
+    def _try_grant(self, ticket):
+        if self._waiting[0] is not ticket:
+            return None
+        now = time.monotonic()
+        reserve = 0 if ticket.priority == INTERACTIVE else self.interactive_reserve
+        wait = max(self._requests.wait_time(1, now, reserve), self._tokens.wait_time(ticket.tokens, now, reserve))
+        if wait > 0:
+            return wait
+
+        self._requests.take(1, reserve)
+        self._tokens.take(ticket.tokens, reserve)
+        heapq.heappop(self._waiting)
+        self._depth[ticket.priority] -= 1
+        self._granted[ticket.priority] += 1
+        self._wait_seconds[ticket.priority] += now - ticket.queued
+        self._condition.notify_all()
+        return 0
+
+
+# the OpenAI rate limits of the account (0 for no limit)
+REQUESTS_PER_MINUTE = int(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', 200))
+TOKENS_PER_MINUTE = int(os.environ.get('OPENAI_TOKENS_PER_MINUTE', 40000))
+
+scheduler = Scheduler(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+queue_depth = metrics.registry.gauge(
+    'grader_scheduler_queue_depth', 'LLM calls waiting in the scheduler for the rate limits, by priority',
+    lambda: {(('priority', priority),): values['queue_depth'] for priority, values in scheduler.metrics().items()})
@@ -0,0 +1,90 @@
+import re
+
+SCORE_FIELDS = ('table', 'total', 'summary', 'comparison')
+MAX_SECTION_SCORE = 3
+
+
+def _normalize(name):
+    return re.sub(r'[^a-z0-9]+', ' ', name.lower()).strip()
+
+
+def parse_table(table):
+    # returns the (criteria, score) of each row of the markdown grading table, skipping its heading
+    rows = []
+    for line in table.splitlines():
+        cells = [cell.strip() for cell in line.strip().strip('|').split('|')]
+        if len(cells) < 2 or not line.strip().startswith('|'):
+            continue
+        if re.fullmatch(r':?-+:?', cells[0]) or _normalize(cells[1]) == 'score':
+            continue
+        match = re.search(r'\d+', cells[1])
+        if not match:
+            raise Exception(f'row has no score: {line}')
+        rows.append((cells[0], int(match.group(0))))
+    return rows
+
+
+def section_matches(criteria, section):
+    criteria, section = _normalize(criteria), _normalize(section)
+    return criteria == section or criteria in section or section in criteria
+
+
+def match_sections(names, sections):
+    # returns the index of the one name that matches each section (None if there isn't one), matching exact
+    # names first so that a row for "Evidence" isn't also taken as a row for "Use of Evidence"
+    matches = [None] * len(sections)
+    for exact in (True, False):
+        taken = set(matches)
+        for i, section in enumerate(sections):
+            if matches[i] is not None:
+                continue
+            matching = [j for j, name in enumerate(names) if j not in taken and (
+                _normalize(name) == _normalize(section) if exact else section_matches(name, section))]
+            if len(matching) == 1:
+                matches[i] = matching[0]
+                taken.add(matching[0])
+    return matches
+
+
+def check_table(table, rubric):
+    rows = parse_table(table)
+    if len(rows) != len(rubric):
+        raise Exception(f'table has {len(rows)} rows for {len(rubric)} rubric sections')
+    names = [criteria for criteria, row_score in rows]
+    matches = match_sections(names, [section['section'] for section in rubric])
+    for section, match in zip(rubric, matches):
+        if match is None:
+            matching = [j for j, name in enumerate(names)
+                        if j not in matches and section_matches(name, section['section'])]
+            raise Exception(f'table has {len(matching)} rows for rubric section "{section["section"]}"')
+    for criteria, row_score in rows:
+        if not 0 <= row_score <= MAX_SECTION_SCORE:
+            raise Exception(f'score out of range for "{criteria}": {row_score}')
+    return rows
+
+
+def check_score_field(field, value, rubric):
+    # the checks that each field can be given on its own, as soon as it has been generated
+    if field in ('table', 'summary', 'comparison') and not isinstance(value, str):
+        raise Exception(f'score field "{field}" isn\'t a string: {value}')
+    if field == 'summary' and not value:
+        raise Exception('score has an empty summary')
+    if field == 'table':
+        check_table(value, rubric)
+
+
+def check_score(score, rubric, max_score):
+    # checks the grading against the rubric without another LLM call, and corrects a miscounted total
+    for field in SCORE_FIELDS:
+        if field not in score:
+            raise Exception(f'score is missing the "{field}" field')
+    for field in ('table', 'summary', 'comparison'):
+        check_score_field(field, score[field], rubric)
+
+    total = sum(row_score for criteria, row_score in parse_table(score['table']))
+    if total > max_score:
+        raise Exception(f'total {total} is more than the maximum score {max_score}')
+    if score['total'] != total:
+        print(f'correcting total from {score["total"]} to {total}')
+        score['total'] = total
+    return score
@@ -0,0 +1,17 @@
+# phrases that identify which of the templates in main.py a prompt was rendered from
+TEMPLATE_MARKERS = (
+    ('rubric', 'Create a rubric for grading an essay'),
+    ('question', 'Create a free-response essay prompt'),
+    ('validity', 'Your only task at this stage is to verify'),
+    ('fused_grading', 'asks you to check and score an essay'),
+    ('grading_qa', 'evaluate the quality of the grading'),
+    ('grading', 'asks you to score an essay'),
+    ('test', 'You are to write an essay that would be produced'),
+)
+
+
+def template_kind(prompt):
+    for kind, marker in TEMPLATE_MARKERS:
+        if marker in prompt:
+            return kind
+    return None
@@ -0,0 +1,104 @@
+import json
+import pytest
+import metrics
+from json_stream import JSONStreamError, JSONStreamParser
+
+DOCUMENTS = [
+    '{}',
+    '[]',
+    '{"valid": true, "feedback": "Good work."}',
+    '{"a": [1, -2.5, 3e2, null, false], "b": {"c": {}}}',
+    '[{"section": "Organization", "criteria": [{"description": "x", "score": 0}]}]',
+    '{"text": "a \\"quoted\\" word, a backslash \\\\ and \\u00e9"}',
+    '{"text": "a } and a ] and a , inside a string"}',
+    ' \n{ "spaced" :\t[ 1 , 2 ] }\n',
+]
+
+
+def feed_in_pieces(parser, text, size):
+    for end in range(size, len(text) + size, size):
+        parser.feed(text[:end])
+
+
+@pytest.mark.parametrize('document', DOCUMENTS)
+@pytest.mark.parametrize('size', [1, 3, 1000])
+def test_parses_like_json_loads(document, size):
+    parser = JSONStreamParser(list if document.strip().startswith('[') else dict)
+    feed_in_pieces(parser, document, size)
+    assert parser.done
+    assert parser.value == json.loads(document)
+
+
+def test_raw_newlines_in_strings_are_allowed():
+    parser = JSONStreamParser()
+    parser.feed('{"summary": "line one\nline two"}')
+    assert parser.value == {'summary': 'line one\nline two'}
+
+
+def test_incomplete_output_is_not_done():
+    parser = JSONStreamParser()
+    parser.feed('{"valid": true, "feedback": "Go')
+    assert not parser.done
+    assert parser.value is None
+
+
+def test_number_is_only_complete_once_something_follows_it():
+    checked = []
+    parser = JSONStreamParser(check=lambda path, value: checked.append((path, value)))
+    parser.feed('{"score": 12')
+    assert checked == []
+    parser.feed('{"score": 12}')
+    assert checked == [(('score',), 12), ((), {'score': 12})]
+
+
+def test_check_is_called_with_the_path_of_each_value_as_soon_as_it_is_complete():
+    checked = []
+    parser = JSONStreamParser(list, lambda path, value: checked.append((path, value)))
+    parser.feed('[{"a": "x", "b": [true')
+    assert checked == [((0, 'a'), 'x'), ((0, 'b', 0), True)]
+    parser.feed('[{"a": "x", "b": [true]}]')
+    assert checked[2:] == [((0, 'b'), [True]), ((0,), {'a': 'x', 'b': [True]}), ((), [{'a': 'x', 'b': [True]}])]
+
+
+def test_failed_check_is_a_sanity_check_error():
+    def check(path, value):
+        if path == ('valid',) and not isinstance(value, bool):
+            raise Exception('not a boolean')
+
+    parser = JSONStreamParser(check=check)
+    with pytest.raises(JSONStreamError) as error:
+        parser.feed('{"valid": "yes", "feedback": ')
+    assert error.value.reason == metrics.SANITY_CHECK
+    assert 'not a boolean' in str(error.value)
+
+
+@pytest.mark.parametrize('expect, text', [
+    (dict, '[1, 2]'),
+    (list, '{"a": 1}'),
+    (dict, 'Here is the JSON: {'),
+    (dict, '{"a": tru3}'),
+    (dict, '{"a": 1]'),
+    (dict, '{"a" 1}'),
+    (dict, '{1: 2}'),
+    (dict, '{"a": 1 "b": 2}'),
+    (dict, '{"a": 1} and some more'),
+    (list, '[1, +]'),
+])
+def test_invalid_output_fails_as_soon_as_it_is_seen(expect, text):
+    parser = JSONStreamParser(expect)
+    with pytest.raises(JSONStreamError) as error:
+        parser.feed(text)
+    assert error.value.reason == metrics.JSON_PARSE
+
+
+def test_whitespace_after_the_json_is_allowed():
+    parser = JSONStreamParser()
+    parser.feed('{"a": 1}\n\n')
+    assert parser.done
+
+
+def test_output_that_changes_is_an_error():
+    parser = JSONStreamParser()
+    parser.feed('{"a": ')
+    with pytest.raises(JSONStreamError):
+        parser.feed('{"b": 1}')
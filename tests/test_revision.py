@@ -0,0 +1,101 @@
+import json
+
+import revision
+from revision import compare, essay_diff, essay_key, graded, revision_context, sentences
+
+PREVIOUS = ('Baseball is a fun game. I like to play it with my friends. We play every Saturday at the park. '
+            'My favorite position is pitcher. I hope to play on a real team one day.')
+
+TABLE = """| Criteria | Score |
+| --- | --- |
+| Organization | 2 |
+| Vocabulary | 3 |
+"""
+
+
+def test_essay_key_ignores_surrounding_whitespace():
+    assert essay_key('  An essay.\n') == essay_key('An essay.')
+    assert essay_key('An essay.') != essay_key('Another essay.')
+
+
+def test_sentences_are_split_at_their_ends_with_whitespace_collapsed():
+    assert sentences(' One.  Two!\nThree?  Four ') == ['One.', 'Two!', 'Three?', 'Four']
+
+
+def test_unchanged_essay_has_no_changes():
+    assert essay_diff(PREVIOUS, PREVIOUS) == '5 of the 5 sentences of the previous essay are unchanged.'
+
+
+def test_changed_sentences_are_removed_and_added():
+    essay = PREVIOUS.replace('My favorite position is pitcher.', 'I love pitching.')
+    assert essay_diff(PREVIOUS, essay) == ('4 of the 5 sentences of the previous essay are unchanged.\n'
+                                           '- My favorite position is pitcher.\n'
+                                           '+ I love pitching.')
+
+
+def test_long_added_sentences_are_cut_short():
+    added = 'One two three four five six seven eight nine ten.'
+    diff = essay_diff(PREVIOUS, PREVIOUS + ' ' + added)
+    assert diff.splitlines()[-1] == '+ One two three four five six seven eight ...'
+
+
+def test_rewrite_is_summarised_only_when_asked():
+    essay = 'Soccer is better. I play it every day. It is the best sport.'
+    assert essay_diff(PREVIOUS, essay, rewrite_summary=True) == (
+        '0 of the 5 sentences of the previous essay are unchanged. The essay was rewritten, with 3 new sentences.')
+    assert essay_diff(PREVIOUS, essay).count('\n- ') == 5
+
+
+def test_small_change_isnt_summarised_as_a_rewrite():
+    essay = PREVIOUS.replace('Baseball is a fun game.', 'Baseball is a great game.')
+    assert '- Baseball is a fun game.' in essay_diff(PREVIOUS, essay, rewrite_summary=True)
+
+
+def test_short_previous_essay_gets_no_context():
+    assert revision_context('Too short to compare.', PREVIOUS) == ''
+    assert revision_context(' '.join(['word'] * revision.MIN_PREVIOUS_WORDS), PREVIOUS) == ''
+
+
+def test_context_has_the_previous_grading_and_the_changes():
+    previous = {'scores': {'Organization': 2}, 'total': 2, 'summary': 'Good.'}
+    context = revision_context(PREVIOUS, PREVIOUS + ' The end.', previous)
+    assert context.splitlines()[0] == 'Previous grading: ' + json.dumps(previous)
+    assert context.splitlines()[1] == 'Changes (- removed, + added):'
+    assert context.splitlines()[-1] == '+ The end.'
+
+
+def test_graded_keeps_the_section_scores_total_and_summary():
+    assert graded({'table': TABLE, 'total': 5, 'summary': 'Nice.', 'comparison': ''}) == {
+        'scores': {'Organization': 2, 'Vocabulary': 3}, 'total': 5, 'summary': 'Nice.'}
+
+
+def test_compare_puts_the_section_scores_in_front_of_the_comparison():
+    previous = {'scores': {'**Organization**': 1, 'Vocabulary': 3}, 'total': 4, 'summary': ''}
+    score = {'table': TABLE, 'total': 5, 'summary': '', 'comparison': 'Better paragraphs.'}
+    assert compare(score, previous)['comparison'] == (
+        'Your total score went up, from 4 to 5.\n\n'
+        '| Criteria | Previous Score | Score |\n| --- | --- | --- |\n'
+        '| Organization | 1 | 2 |\n| Vocabulary | 3 | 3 |\n\n'
+        'Better paragraphs.')
+    assert score['comparison'] == 'Better paragraphs.'
+
+
+def test_compare_says_when_the_total_went_down_or_stayed_the_same():
+    score = {'table': TABLE, 'total': 5, 'summary': '', 'comparison': ''}
+    assert compare(score, {'scores': {'Organization': 3}, 'total': 6})['comparison'].startswith(
+        'Your total score went down, from 6 to 5.')
+    assert compare(score, {'scores': {'Organization': 2}, 'total': 5})['comparison'].endswith(
+        '| Organization | 2 | 2 |')
+
+
+def test_compare_leaves_the_score_alone_without_a_previous_grading_to_match():
+    score = {'table': TABLE, 'total': 5, 'summary': '', 'comparison': 'Same.'}
+    assert compare(score, None) is score
+    assert compare(score, {'scores': {'Grammar': 1}, 'total': 1}) is score
+
+
+def test_compare_matches_overlapping_section_names_to_their_own_scores():
+    table = '| Criteria | Score |\n| --- | --- |\n| Use of Evidence | 3 |\n| Evidence | 1 |\n'
+    previous = {'scores': {'Evidence': 2, 'Use of Evidence': 1}, 'total': 3}
+    comparison = compare({'table': table, 'total': 4, 'summary': '', 'comparison': ''}, previous)['comparison']
+    assert comparison.endswith('| Use of Evidence | 1 | 3 |\n| Evidence | 2 | 1 |')
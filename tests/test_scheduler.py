@@ -0,0 +1,146 @@
+import asyncio
+import time
+
+import pytest
+
+import metrics
+from scheduler import BACKGROUND, BATCH, INTERACTIVE, Scheduler, TokenBucket
+
+
+def drained(per_minute, now=100.0):
+    bucket = TokenBucket(per_minute)
+    bucket.take(per_minute)
+    bucket.updated = now
+    return bucket
+
+
+def test_bucket_starts_full():
+    bucket = TokenBucket(60)
+    assert bucket.wait_time(60, bucket.updated) == 0
+
+
+def test_bucket_refills_at_its_rate():
+    bucket = drained(60)
+    assert bucket.wait_time(1, 100.0) == pytest.approx(1.0)
+    assert bucket.wait_time(1, 100.5) == pytest.approx(0.5)
+    assert bucket.wait_time(1, 101.0) == 0
+
+
+def test_bucket_never_refills_past_its_capacity():
+    bucket = drained(60)
+    assert bucket.wait_time(60, 1000.0) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1, 1000.0) == pytest.approx(1.0)
+
+
+def test_requests_larger_than_the_bucket_only_wait_for_a_full_bucket():
+    bucket = drained(60)
+    assert bucket.wait_time(600, 100.0) == pytest.approx(60.0)
+
+
+@pytest.mark.parametrize('per_minute', [0, None])
+def test_bucket_without_a_limit_never_waits(per_minute):
+    bucket = TokenBucket(per_minute)
+    bucket.take(1000000)
+    assert bucket.wait_time(1000000, bucket.updated) == 0
+
+
+def test_reserve_is_left_in_the_bucket():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    assert bucket.wait_time(45, now, 0.25) == 0
+    bucket.take(45, 0.25)
+    assert bucket.wait_time(1, now, 0.25) == pytest.approx(1.0)
+    assert bucket.wait_time(15, now) == 0
+
+
+def test_requests_larger_than_the_bucket_cant_take_the_reserve():
+    bucket = TokenBucket(60)
+    bucket.take(600, 0.25)
+    assert bucket.wait_time(15, bucket.updated) == 0
+    assert bucket.wait_time(16, bucket.updated) > 0
+
+
+def test_scheduler_without_limits_grants_everything():
+    scheduler = Scheduler(0, 0)
+    for _ in range(100):
+        scheduler.acquire(BATCH, 100000)
+    assert scheduler.metrics()['batch']['granted'] == 100
+
+
+def test_higher_priorities_are_granted_first():
+    # 100 requests a second, so each request waits about 10ms once the bucket is empty
+    scheduler = Scheduler(6000, 0, interactive_reserve=0)
+    scheduler._requests.tokens = 0
+    order = []
+
+    async def acquire(priority):
+        await scheduler.acquire_async(priority, 1)
+        order.append(priority)
+
+    async def run():
+        await asyncio.gather(acquire(BATCH), acquire(BACKGROUND), acquire(INTERACTIVE), acquire(BATCH))
+
+    asyncio.run(run())
+    assert order == [INTERACTIVE, BACKGROUND, BATCH, BATCH]
+
+    metrics = scheduler.metrics()
+    assert metrics['batch']['max_queue_depth'] == 2
+    assert metrics['batch']['granted'] == 2
+    assert all(m['queue_depth'] == 0 for m in metrics.values())
+
+
+def test_token_limit_holds_back_requests():
+    scheduler = Scheduler(0, 600)
+    scheduler.acquire(INTERACTIVE, 600)
+
+    async def run():
+        await asyncio.wait_for(scheduler.acquire_async(INTERACTIVE, 100), 0.2)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    scheduler = Scheduler(1, 0)
+    scheduler.acquire(INTERACTIVE, 1)
+
+    async def run():
+        await asyncio.wait_for(scheduler.acquire_async(BATCH, 1), 0.1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
+    metrics = scheduler.metrics()
+    assert metrics['batch']['queue_depth'] == 0
+    assert metrics['batch']['granted'] == 0
+    assert scheduler._waiting == []
+
+
+def test_interactive_calls_arent_held_up_by_earlier_background_calls():
+    scheduler = Scheduler(8, 4000, interactive_reserve=0.25)
+    for _ in range(3):
+        scheduler.acquire(BACKGROUND, 1000)
+
+    async def run():
+        await asyncio.wait_for(scheduler.acquire_async(BATCH, 1000), 0.1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
+    start = time.monotonic()
+    scheduler.acquire(INTERACTIVE, 1000)
+    assert time.monotonic() - start < 0.05
+    assert scheduler.metrics()['interactive']['wait_seconds'] < 0.05
+
+
+def test_queue_depth_is_exported():
+    lines = metrics.registry.render().splitlines()
+    assert 'grader_scheduler_queue_depth{priority="interactive"} 0' in lines
+
+
+def test_spare_capacity_leaves_the_headroom():
+    scheduler = Scheduler(60, 1000)
+    assert scheduler.has_spare(3, 500, 0.5)
+    scheduler.acquire(INTERACTIVE, 600)
+    assert not scheduler.has_spare(3, 500, 0.5)
+    assert scheduler.has_spare(3, 100, 0.2)
+    assert Scheduler(0, 0).has_spare(100, 100000, 0.5)
@@ -0,0 +1,113 @@
+import pytest
+from score_validator import check_score, check_score_field, check_table, parse_table, section_matches
+
+RUBRIC = [{'section': 'Addressing the Topic'}, {'section': 'Organization'}, {'section': 'Grammar and Conventions'}]
+
+TABLE = """| Criteria | Score |
+| --- | --- |
+| **Addressing the Topic** | 3 |
+| **Organization** | 2 / 3 |
+| **Grammar and Conventions** | 1 |
+"""
+
+
+def score(**fields):
+    return {'table': TABLE, 'total': 6, 'summary': 'A solid essay.', 'comparison': '', **fields}
+
+
+def test_parse_table_skips_the_heading_and_separator():
+    assert parse_table(TABLE) == [('**Addressing the Topic**', 3), ('**Organization**', 2),
+                                  ('**Grammar and Conventions**', 1)]
+
+
+def test_parse_table_ignores_lines_that_arent_rows():
+    assert parse_table('Here is the grading:\n' + TABLE + '\nThat is all.') == parse_table(TABLE)
+
+
+def test_row_without_a_score_is_an_error():
+    with pytest.raises(Exception, match='no score'):
+        parse_table('| Organization | N/A |')
+
+
+@pytest.mark.parametrize('criteria, section', [
+    ('**Organization**', 'Organization'),
+    ('Grammar-and-Conventions:', 'grammar and conventions'),
+    ('Organization', 'Organization and Structure'),
+])
+def test_sections_match_regardless_of_formatting(criteria, section):
+    assert section_matches(criteria, section)
+
+
+def test_sections_that_share_no_name_dont_match():
+    assert not section_matches('Vocabulary', 'Organization')
+
+
+def test_table_rows_can_be_in_any_order():
+    lines = TABLE.splitlines()
+    reordered = '\n'.join(lines[:2] + lines[:1:-1])
+    assert [row[1] for row in check_table(reordered, RUBRIC)] == [1, 2, 3]
+
+
+def test_table_missing_a_section_is_an_error():
+    with pytest.raises(Exception, match='2 rows for 3 rubric sections'):
+        check_table('\n'.join(TABLE.splitlines()[:-1]), RUBRIC)
+
+
+def test_table_with_a_section_twice_is_an_error():
+    table = TABLE.replace('Grammar and Conventions', 'Organization')
+    with pytest.raises(Exception, match='2 rows for rubric section "Organization"'):
+        check_table(table, RUBRIC)
+
+
+def test_score_out_of_range_is_an_error():
+    with pytest.raises(Exception, match='out of range'):
+        check_table(TABLE.replace('| 3 |', '| 4 |'), RUBRIC)
+
+
+def test_miscounted_total_is_corrected():
+    assert check_score(score(total=9), RUBRIC, 9)['total'] == 6
+
+
+def test_total_over_the_maximum_is_an_error():
+    with pytest.raises(Exception, match='more than the maximum'):
+        check_score(score(), RUBRIC, 5)
+
+
+def test_missing_field_is_an_error():
+    graded = score()
+    del graded['comparison']
+    with pytest.raises(Exception, match='missing the "comparison" field'):
+        check_score(graded, RUBRIC, 9)
+
+
+@pytest.mark.parametrize('field, value, message', [
+    ('summary', '', 'empty summary'),
+    ('summary', None, "isn't a string"),
+    ('comparison', 3, "isn't a string"),
+    ('table', ['not', 'a', 'table'], "isn't a string"),
+])
+def test_bad_fields_are_errors(field, value, message):
+    with pytest.raises(Exception, match=message):
+        check_score_field(field, value, RUBRIC)
+
+
+def test_fields_without_checks_of_their_own_pass():
+    check_score_field('total', 'anything', RUBRIC)
+
+
+@pytest.mark.parametrize('sections', [
+    ['Use of Evidence', 'Evidence', 'Organization'],
+    ['Conventions', 'Language and Conventions', 'Organization'],
+    ['Organization', 'Evidence', 'Use of Evidence'],
+])
+def test_section_names_that_contain_each_other_match_their_own_rows(sections):
+    rubric = [{'section': section} for section in sections]
+    table = '| Criteria | Score |\n| --- | --- |\n' + ''.join(
+        f'| **{section}** | {score} |\n' for score, section in enumerate(reversed(sections)))
+    assert dict(check_table(table, rubric)) == {f'**{section}**': 2 - i for i, section in enumerate(sections)}
+
+
+def test_rows_that_only_contain_a_section_name_still_match_it():
+    rubric = [{'section': 'Evidence'}, {'section': 'Organization and Structure'}]
+    table = '| Criteria | Score |\n| --- | --- |\n| Use of Evidence | 2 |\n| Organization | 1 |\n'
+    assert check_table(table, rubric) == [('Use of Evidence', 2), ('Organization', 1)]
@@ -0,0 +1,150 @@
+import atexit
+import contextvars
+import json
+import math
+import os
+import threading
+from collections import deque
+import metrics
+from rubric_store import CACHE_DIR
+
+DEFAULT_TOKEN_CAPS_FILE = os.environ.get('TOKEN_CAPS_FILE', os.path.join(CACHE_DIR, 'token_caps.json'))
+# cap each template's completions by what its calls have needed so far, instead of its fixed maximum
+ADAPTIVE = os.environ.get('ADAPTIVE_MAX_TOKENS', '1') not in ('', '0')
+
+# the cap is this percentile of the recent completion sizes, with a margin on top, once there are enough of them
+CAP_PERCENTILE = 99
+CAP_MARGIN = 1.5
+MIN_SAMPLES = 20
+MIN_CAP = 64
+CAP_ROUNDING = 64
+WINDOW = 500
+# how many new completion sizes are recorded between saves of the file
+SAVE_EVERY = 20
+# a completion that has used this much of its cap is taken to have been cut off by it
+TRUNCATION_FRACTION = 0.9
+
+# the finish reasons of the completions that the LLM call being made has had so far, which the backend
+# wrappers add to (a finish reason of 'length' means that the completion was cut off by its cap)
+finish_reasons = contextvars.ContextVar('finish_reasons', default=None)
+
+truncations = metrics.registry.counter('grader_llm_truncations_total',
+                                       'LLM outputs cut off by their adaptive token cap, and retried with a larger one')
+
+
+class TruncatedError(Exception):
+    pass
+
+
+def _key(template, model):
+    return f'{template}/{model}'
+
+
+# the completion sizes of each template on each model, and the token caps that are derived from them, which are
+# kept in a JSON file so that a restarted process doesn't have to learn them again
+class TokenCaps:
+    def __init__(self, path=DEFAULT_TOKEN_CAPS_FILE, adaptive=ADAPTIVE):
+        self.path = path
+        self.adaptive = adaptive
+        self._sizes = {}
+        self._prompts = {}
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def cap(self, template, model, maximum):
+        if not self.adaptive:
+            return maximum
+        with self._lock:
+            sizes = sorted(self._sizes.get(_key(template, model), ()))
+        if len(sizes) < MIN_SAMPLES:
+            return maximum
+        observed = sizes[min(len(sizes) - 1, int(CAP_PERCENTILE / 100 * len(sizes)))]
+        cap = math.ceil(observed * CAP_MARGIN / CAP_ROUNDING) * CAP_ROUNDING
+        return min(maximum, max(MIN_CAP, cap))
+
+    @staticmethod
+    def larger_cap(cap, maximum):
+        return min(maximum, cap * 2)
+
+    @staticmethod
+    def record_truncation(template):
+        with metrics.registry.lock:
+            truncations.inc(template=template)
+        metrics.registry.trace({'event': 'truncated', 'template': template})
+
+    def record(self, template, model, completion_tokens, prompt_tokens):
+        with self._lock:
+            key = _key(template, model)
+            self._sizes.setdefault(key, deque(maxlen=WINDOW)).append(completion_tokens)
+            tokens, calls = self._prompts.get(key, (0, 0))
+            self._prompts[key] = (tokens + prompt_tokens, calls + 1)
+            self._unsaved += 1
+            save = self._unsaved >= SAVE_EVERY
+        if save:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            if not self._unsaved:
+                return
+            data = {'templates': {key: {'completion_tokens': list(sizes), 'prompt_tokens': self._prompts[key][0],
+                                        'calls': self._prompts[key][1]} for key, sizes in self._sizes.items()}}
+            self._unsaved = 0
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # write a new file and then replace the old one, so that a crash doesn't leave half a file
+            with open(self.path + '.tmp', 'w') as file:
+                json.dump(data, file)
+            os.replace(self.path + '.tmp', self.path)
+        except Exception as exc:
+            print(f'error saving token caps: {exc}')
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+            for key, entry in data['templates'].items():
+                self._sizes[key] = deque(entry['completion_tokens'], maxlen=WINDOW)
+                self._prompts[key] = (entry['prompt_tokens'], entry['calls'])
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            print(f'error loading token caps: {exc}')
+
+    def report(self, maximums, tokens_per_minute=None):
+        # for each template and model, the completion sizes, the cap, and the rate limit headroom that capping it
+        # gives back: the tokens that the scheduler reserves per call, and the calls per minute that fit in the limit
+        with self._lock:
+            keys = sorted(self._sizes)
+            sizes = {key: sorted(self._sizes[key]) for key in keys}
+            prompts = dict(self._prompts)
+        report = {}
+        for key in keys:
+            template, model = key.split('/', 1)
+            if template not in maximums or not sizes[key]:
+                continue
+            tokens, calls = prompts.get(key, (0, 0))
+            prompt = tokens / calls if calls else 0
+            cap = self.cap(template, model, maximums[template])
+            entry = {
+                'samples': len(sizes[key]),
+                'p50': sizes[key][len(sizes[key]) // 2],
+                'p99': sizes[key][min(len(sizes[key]) - 1, int(0.99 * len(sizes[key])))],
+                'max': sizes[key][-1],
+                'fixed_cap': maximums[template],
+                'cap': cap,
+                'prompt_tokens': prompt,
+                'reserved_per_call_fixed': prompt + maximums[template],
+                'reserved_per_call': prompt + cap,
+                'headroom': 1 - (prompt + cap) / (prompt + maximums[template]),
+            }
+            if tokens_per_minute:
+                entry['calls_per_minute_fixed'] = tokens_per_minute / entry['reserved_per_call_fixed']
+                entry['calls_per_minute'] = tokens_per_minute / entry['reserved_per_call']
+            report[key] = entry
+        return report
+
+
+token_caps = TokenCaps()
+atexit.register(token_caps.save)
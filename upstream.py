@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+import metrics
+
+# the longest each stage may take, including all of its retries, in seconds (None for no limit), which
+# can be changed with STAGE_DEADLINES, as a JSON object of stage names and seconds (0 for no limit)
+DEFAULT_STAGE_DEADLINES = {'rubric': 180, 'question': 120, 'validity': 45, 'score': 90, 'fused_grading': 90,
+                           'test': 90}
+STAGE_DEADLINES = {stage: seconds or None for stage, seconds in
+                   {**DEFAULT_STAGE_DEADLINES, **json.loads(os.environ.get('STAGE_DEADLINES', '{}'))}.items()}
+
+# exponential backoff between the tries of a stage, with full jitter
+BACKOFF_BASE = float(os.environ.get('BACKOFF_BASE_SECONDS', 0.5))
+BACKOFF_CAP = float(os.environ.get('BACKOFF_CAP_SECONDS', 8))
+
+# send a duplicate of a call that has taken longer than this percentile of its template's latency, and
+# use whichever answers validly first (off unless HEDGE_PERCENTILE is set)
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 0)) or None
+# calls of a template that have to have been timed before its calls are hedged
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+# consecutive upstream failures that open the circuit, and how long it stays open before a trial call
+CIRCUIT_FAILURES = int(os.environ.get('CIRCUIT_FAILURES', 5))
+CIRCUIT_COOLDOWN = float(os.environ.get('CIRCUIT_COOLDOWN_SECONDS', 30))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+hedged_calls = metrics.registry.counter('grader_llm_hedged_calls_total',
+                                        'Duplicate LLM calls sent for slow calls, by template and which one won')
+circuit_transitions = metrics.registry.counter('grader_circuit_transitions_total',
+                                               'Changes of the upstream circuit breaker state, by new state')
+circuit_rejections = metrics.registry.counter('grader_circuit_rejections_total',
+                                              'LLM calls not made because the upstream circuit was open')
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+# the time that a stage has left to finish in
+class Deadline:
+    def __init__(self, stage, seconds=None):
+        self.stage = stage
+        self.seconds = seconds if seconds is not None else STAGE_DEADLINES.get(stage)
+        self.end = time.monotonic() + self.seconds if self.seconds else None
+
+    def remaining(self):
+        return None if self.end is None else max(0.0, self.end - time.monotonic())
+
+    def expired(self):
+        return self.end is not None and time.monotonic() >= self.end
+
+
+def backoff(tries, deadline):
+    # how long to wait before the next try, or None if there isn't time for another one
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (tries - 1)))
+    remaining = deadline.remaining()
+    if remaining is not None and delay >= remaining:
+        return None
+    return delay
+
+
+# stops calls to the upstream API for a while once it has failed several times in a row, so that
+# sessions fail fast instead of each waiting out their own retries, then lets one trial call through
+# to find out whether it has recovered
+class CircuitBreaker:
+    def __init__(self, failures=CIRCUIT_FAILURES, cooldown=CIRCUIT_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self._consecutive = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        # raises CircuitOpenError if the call shouldn't be made, returns whether it is the trial call
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened >= self.cooldown:
+                self._set_state(HALF_OPEN)
+            if self.state == CLOSED:
+                return False
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            retry_in = max(0.0, self.cooldown - (time.monotonic() - self._opened)) if self._opened else 0
+        with metrics.registry.lock:
+            circuit_rejections.inc()
+        raise CircuitOpenError(f'upstream circuit is {self.state}, retry in {retry_in:.0f}s')
+
+    def succeeded(self, trial=False):
+        with self._lock:
+            self._consecutive = 0
+            if trial:
+                self._trial = False
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def failed(self, trial=False):
+        with self._lock:
+            self._consecutive += 1
+            if trial:
+                self._trial = False
+            if self.state == HALF_OPEN or (self.failures and self._consecutive >= self.failures):
+                self._opened = time.monotonic()
+                if self.state != OPEN:
+                    self._set_state(OPEN)
+
+    def available(self):
+        # whether a call could be made now, without taking up the trial call
+        with self._lock:
+            return self.state != OPEN or time.monotonic() - self._opened >= self.cooldown
+
+    def cancelled(self, trial=False):
+        # a call that was abandoned says nothing about the upstream, but lets another trial call through
+        if trial:
+            with self._lock:
+                self._trial = False
+
+    def _set_state(self, state):
+        self.state = state
+        with metrics.registry.lock:
+            circuit_transitions.inc(state=state)
+        metrics.registry.trace({'event': 'circuit', 'state': state})
+
+
+# recent latencies of successful calls, by any key such as the template, to decide when a call is slow
+class LatencyTracker:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, seconds):
+        with self._lock:
+            self._latencies.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, key, pct, min_samples=HEDGE_MIN_SAMPLES):
+        # None until there have been enough calls to go by
+        with self._lock:
+            values = sorted(self._latencies.get(key, ()))
+        if len(values) < min_samples:
+            return None
+        return values[min(len(values) - 1, int(pct / 100 * len(values)))]
+
+
+def record_hedge(template, winner):
+    with metrics.registry.lock:
+        hedged_calls.inc(template=template, winner=winner)
+    metrics.registry.trace({'event': 'hedge', 'template': template, 'winner': winner})
+
+
+async def hedged(template, delay, make_call):
+    # runs make_call(), and if it hasn't finished after delay seconds (None to never hedge), runs a second one
+    # alongside it; the first to succeed wins and the other is cancelled, and if both fail the first's error
+    # is raised
+    calls = [asyncio.ensure_future(make_call())]
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(calls, timeout=delay)
+            if not done:
+                calls.append(asyncio.ensure_future(make_call()))
+        if len(calls) == 1:
+            return await calls[0]
+
+        pending = set(calls)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for call in done:
+                if call.exception() is None:
+                    record_hedge(template, 'first' if call is calls[0] else 'hedge')
+                    return call.result()
+        record_hedge(template, 'none')
+        raise calls[0].exception()
+    finally:
+        losers = [call for call in calls if not call.done()]
+        for call in losers:
+            call.cancel()
+        if losers:
+            await asyncio.wait(losers)